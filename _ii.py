@@ -1,19 +1,30 @@
 #!/bin/env python
 """
 "I'm in" environment control utility.
+
+The most common commands (see FAST_COMMANDS) are executed without importing clikit, which is only
+loaded (see CreateApp) for the other commands, help and usage errors. Those commands are sent to
+the shellmatic server (see Serve) when one is configured, so "ii" itself doesn't even import
+shellmatic.
+
+The generated BATCH script is written to SHELLMATIC_BATCH or, if it is "-" (eval mode), to stdout,
+with all the other output going to stderr:
+
+    for /f "delims=" %i in ('python _ii.py reset') do call %i
+
+Scripts are generated for cmd.exe unless SHELLMATIC_SHELL selects another shell, eg.:
+
+    eval "$(SHELLMATIC_SHELL=bash SHELLMATIC_BATCH=- python _ii.py reset)"
 """
 from __future__ import unicode_literals
-from ben10.execute import GetUnicodeArgv
-from ben10.filesystem import CreateFile
-from clikit.app import App
-from shellmatic import LOGO, Shellmatic as _Shellmatic
 import os
+import sys
 
 
-app = App('shellmatic', 'Automatic Shell.')
+# Where the eval mode writes the BATCH scripts (see _OutputBatch). None for sys.stdout.
+_script_stream = None
 
 
-@app.Fixture
 def Config():
 
     class _Config(object):
@@ -24,7 +35,23 @@ def Config():
 
         @property
         def batch_filename(self):
-            return os.environ.get('SHELLMATIC_BATCH', '$TEMP/.shellmatic.bat')
+            '''
+            The generated BATCH script file, or "-" for the eval mode. Defaults to a file for the
+            shell running "ii" (its process id), so concurrent shells never share it.
+            '''
+            result = os.environ.get('SHELLMATIC_BATCH')
+            if result:
+                return result
+            # Python 2 on Windows has no getppid: the file is then unique for each "ii".
+            shell_pid = getattr(os, 'getppid', os.getpid)()
+            return '$TEMP/.shellmatic-%d.bat' % shell_pid
+
+        @property
+        def shell(self):
+            '''
+            The shell executing the generated scripts: cmd (default), powershell, bash, zsh or fish.
+            '''
+            return os.environ.get('SHELLMATIC_SHELL', 'cmd')
 
         @property
         def user_filename(self):
@@ -34,32 +61,199 @@ def Config():
         def project_filename(self):
             return '.eladrin.json'
 
+        @property
+        def projects_cache_filename(self):
+            return '$APPDATA/.shellmatic-projects.cache'
+
+        @property
+        def projects_index_filename(self):
+            return '$APPDATA/.shellmatic-projects.index'
+
+        @property
+        def macros_filename(self):
+            '''
+            The doskey macros file with the aliases, for cmd.exe.
+            '''
+            return '$APPDATA/.shellmatic-macros.doskey'
+
+        @property
+        def calls_state_filename(self):
+            return '$APPDATA/.shellmatic-calls.state'
+
+        @property
+        def executables_index_filename(self):
+            return '$APPDATA/.shellmatic-executables.index'
+
+        @property
+        def shims_dir(self):
+            '''
+            The directory with a shim (launcher) for every command in PATH (see executables).
+            '''
+            return '$APPDATA/.shellmatic-shims'
+
+        @property
+        def server_address(self):
+            '''
+            The local socket (named pipe on Windows) of the shellmatic server. "ii" only uses the
+            server if SHELLMATIC_SERVER is set.
+            '''
+            result = os.environ.get('SHELLMATIC_SERVER')
+            if result:
+                return result
+            if os.name == 'nt':
+                return r'\\.\pipe\shellmatic-' + os.environ.get('USERNAME', '')
+            return os.path.expanduser('~/.shellmatic.sock')
+
+        @property
+        def server_key_filename(self):
+            return '$APPDATA/.shellmatic.key'
+
     return _Config()
 
 
-@app.Fixture
 def Shellmatic():
+    from shellmatic import Shellmatic as _Shellmatic
+
     shellmatic = _Shellmatic()
     return shellmatic
 
 
-@app
-def Reset(console_, shellmatic_, config_, shared_dir=None, projects_dir=None, test=False):
+def _GenerateScript(shellmatic_, config_, append=False, roots=None, full=False):
+    '''
+    Generates the script changing the current environment, for the configured shell.
+
+    :param bool full:
+        If True the script sets every variable, not only the ones differing from the current
+        environment.
+    '''
+    return shellmatic_.AsScript(
+        config_.shell,
+        append=append,
+        environ=None if full else os.environ,
+        roots=roots,
+        coalesce=True,
+    )
+
+
+def _OutputBatch(console_, config_, batch_contents, test):
+    '''
+    Writes the generated batch for "ii" to execute or, when testing, prints it.
+    '''
+    if test:
+        console_.Print(batch_contents, indent=1)
+    elif config_.batch_filename == '-':
+        _FastConsole(_script_stream).Write(batch_contents + '\n')
+    else:
+        _CreateBatchFile(os.path.expandvars(config_.batch_filename), batch_contents)
+
+
+def _CreateBatchFile(filename, contents):
+    '''
+    Creates the batch file atomically: the contents are written to a unique temporary file, renamed
+    to the batch file when complete. Concurrent "ii" never execute a partially written script.
+
+    Written with io (native end of lines) rather than ben10.filesystem, kept out of the fast path.
+
+    :param unicode filename:
+    :param unicode contents:
+    '''
+    import io
+    import tempfile
+
+    directory, basename = os.path.split(filename)
+    fd, temp_filename = tempfile.mkstemp(prefix=basename + '.', dir=directory or None)
+    try:
+        with io.open(fd, 'w') as batch_file:
+            batch_file.write(contents)
+        try:
+            os.replace(temp_filename, filename)
+        except AttributeError:
+            # Python 2: rename fails on Windows if the file exists.
+            if os.name == 'nt' and os.path.isfile(filename):
+                os.remove(filename)
+            os.rename(temp_filename, filename)
+    finally:
+        if os.path.isfile(temp_filename):
+            os.remove(temp_filename)
+
+
+def Reset(
+    console_,
+    shellmatic_,
+    config_,
+    shared_dir=None,
+    projects_dir=None,
+    roots=None,
+    full=False,
+    test=False,
+):
     """
-    Resets the environment to its default (reset.json).
+    Resets the environment to its default (reset.json), including its aliases. Its calls are
+    executed if changed since their last successful execution.
+
+    :param roots: Comma separated variables: sets only these and the variables they reference.
+    :param full: Sets every variable, not only the changed ones: eg.: a script for a fresh shell.
     """
+    from shellmatic import LOGO
+
     console_.Print(LOGO)
     console_.Print(config_.reset_filename)
-    shellmatic_.LoadJson(config_.reset_filename)
+    shellmatic_.LoadJson(config_.reset_filename, cache=True)
+
+    if not test:
+        _RunCalls(console_, shellmatic_, config_)
+
+    if roots is not None:
+        roots = roots.split(',')
+    batch_contents = _GenerateScript(shellmatic_, config_, roots=roots, full=full)
+    batch_contents = _AddAliases(shellmatic_, config_, batch_contents, test)
+    _OutputBatch(console_, config_, batch_contents, test)
+
+
+def _RunCalls(console_, shellmatic_, config_):
+    '''
+    Runs the changed calls (see Shellmatic.RunCalls), reporting their results.
+    '''
+    calls = shellmatic_.RunCalls(
+        os.path.expandvars(config_.calls_state_filename),
+        environ=os.environ,
+    )
+    for i_name, i_retcode, i_output in calls:
+        if i_retcode == 0:
+            console_.Item('%s: ok' % i_name)
+        else:
+            console_.Item('<red>%s: failed (%d)</>' % (i_name, i_retcode))
+            console_.Print(i_output.rstrip(), indent=1)
+
+
+def _AddAliases(shellmatic_, config_, batch_contents, test):
+    '''
+    :return unicode:
+        The generated script followed by the aliases definitions, for the configured shell. When
+        testing the macros file (cmd.exe) is not written: the macros are shown instead.
+    '''
+    macros_filename = None if test else os.path.expandvars(config_.macros_filename)
+    aliases = shellmatic_.AsAliases(config_.shell, macros_filename)
+    return '\n'.join([i for i in (batch_contents, aliases) if i])
+
+
+def Analyze(console_, shellmatic_, config_, filename=None, roots='PATH'):
+    """
+    Lists the variables of a configuration (defaults to reset.json) that could be removed: dead
+    (not referenced, even indirectly, by the roots) and unreferenced (by any variable).
 
-    batch_contents = shellmatic_.AsBatch(console_)
-    if test:
-        console_.Print(batch_contents, indent=1)
-    else:
-        CreateFile(config_.batch_filename, batch_contents)
+    :param filename: The configuration file.
+    :param roots: Comma separated variables used from the configuration.
+    """
+    shellmatic_.LoadJson(filename or config_.reset_filename)
+    dead, unreferenced = shellmatic_.Analyze(roots.split(','))
+
+    for i_title, i_names in (('Dead', dead), ('Unreferenced', unreferenced)):
+        console_.Print('<green>%s</>' % i_title)
+        for j_name in i_names:
+            console_.Item(j_name, indent=1)
 
 
-@app
 def List(console_, shellmatic_, config_):
     """
     List current shellmatic configuration.
@@ -69,7 +263,7 @@ def List(console_, shellmatic_, config_):
     filename = shellmatic_.PathValue(config_.user_filename)
     if filename.IsFile():
         console_.Print('Loading user database: "%s"' % filename.path)
-        shellmatic_.LoadJson(filename.path)
+        shellmatic_.LoadJson(filename.path, cache=True)
     else:
         console_.Print('Loading environment.')
         shellmatic_.LoadEnvironment()
@@ -79,91 +273,465 @@ def List(console_, shellmatic_, config_):
     shellmatic_.PrintList(console_)
 
 
-@app
-def Load(console_, shellmatic_, config_, filename, test=False):
+def Load(console_, shellmatic_, config_, filename, full=False, test=False):
     """
     Loads a environment file in JSON format.
+
+    :param full: Sets every variable, not only the changed ones (see reset).
     """
+    from shellmatic import LOGO
+
     console_.Print(LOGO)
     shellmatic_.LoadJson(filename)
 
-    batch_contents = shellmatic_.AsBatch(console_)
-    if test:
-        console_.Print(batch_contents, indent=1)
-    else:
-        CreateFile(config_.batch_filename, batch_contents)
+    batch_contents = _GenerateScript(shellmatic_, config_, full=full)
+    _OutputBatch(console_, config_, batch_contents, test)
 
 
-@app
-def Set(console_, shellmatic_, config_, name, value, test=False):
+def Set(console_, shellmatic_, config_, name, value, full=False, test=False):
     """
     Sets an environment variable.
 
     :param name:
     :param value:
+    :param full: Sets every variable, not only the changed ones (see reset).
     """
     shellmatic_.EnvironmentSet(name, value)
     shellmatic_.PrintList(console_)
 
-    batch_contents = shellmatic_.AsBatch(console_)
-    if test:
-        console_.Print(batch_contents, indent=1)
-    else:
-        CreateFile(config_.batch_filename, batch_contents)
+    batch_contents = _GenerateScript(shellmatic_, config_, full=full)
+    _OutputBatch(console_, config_, batch_contents, test)
 
 
-@app(alias=('activate', 'wo'))
-def Workon(console_, shellmatic_, config_, name, test=False):
+def Workon(console_, shellmatic_, config_, name, push=False, test=False):
     """
-    Activate a project's virtualenv.
+    Activate a project's virtualenv, deactivating the current one.
 
-    The virtual environment must be placed on $PROJECTS_DIR/<name>/.venv
+    The virtual environment must be placed on $PROJECTS_DIR/<name>/.venv. The project configuration
+    aliases are defined and its changed calls executed, as in reset.
 
     :param name: The project name.
+    :param push: Keeps the current virtualenv, deactivated (see deactivate) back to it.
     """
-    # Obtain the new project and venv directories
-    new_project_dir = shellmatic_.PathValue('$PROJECTS_DIR/%(name)s' % locals())
-    new_venv_home = shellmatic_.PathValue('%(new_project_dir)s/.venv' % locals())
-    new_scripts_dir = shellmatic_.PathValue('%(new_venv_home)s/scripts' % locals())
+    activated = shellmatic_.Workon(
+        console_,
+        name,
+        config_filename=config_.project_filename,
+        cache_filename=os.path.expandvars(config_.projects_cache_filename),
+        push=push,
+    )
+    if not activated:
+        return
+    if not test:
+        _RunCalls(console_, shellmatic_, config_)
+
+    # Generate the batch script
+    batch_contents = _GenerateScript(shellmatic_, config_, append=True)
+    batch_contents = _AddAliases(shellmatic_, config_, batch_contents, test)
+    _OutputBatch(console_, config_, batch_contents, test)
 
-    # Check if the new virtualenv really exists
-    if not new_venv_home.IsDir():
-        console_.Print('%s: Unable to find virtualenv.' % new_venv_home)
+
+def Deactivate(console_, shellmatic_, config_, test=False):
+    """
+    Deactivates the current virtualenv, restoring the variables changed by its activation.
+    """
+    if not shellmatic_.Deactivate(console_):
         return
 
-    # Unload previous virtualenv (if any)
-    old_name = os.environ.get('VIRTUALENV')
-    if old_name and not old_name.startswith('('):
-        old_venv_home = shellmatic_.PathValue('$PROJECTS_DIR/%(old_name)s/.venv' % locals())
-        old_scripts_dir = shellmatic_.PathValue('%(old_venv_home)s/scripts' % locals())
+    batch_contents = _GenerateScript(shellmatic_, config_, append=True)
+    _OutputBatch(console_, config_, batch_contents, test)
 
-        path = shellmatic_.PathListValue(os.environ['PATH'])
-        path.Remove(old_scripts_dir)
-        shellmatic_.EnvironmentSet('_environ:PATH', path)
 
-    # Load new virtualenv
-    shellmatic_.EnvironmentSet(name + ':PATH', new_scripts_dir.path)
-    shellmatic_.EnvironmentSet(name + ':VIRTUALENV', name)
-    shellmatic_.EnvironmentSet(name + ':PYTHONHOME', new_venv_home.path)
-    console_.Print('%s: Activating virtualenv.' % new_venv_home)
+def Prebuild(console_, shellmatic_, config_):
+    """
+    Builds the activation (see workon) of every project in $PROJECTS_DIR, in parallel.
+    """
+    names = shellmatic_.PrebuildProjects(
+        os.path.expandvars(config_.projects_cache_filename),
+        config_filename=config_.project_filename,
+    )
+    for i_name in names:
+        console_.Item(i_name)
 
-    # Load environment configuration
-    new_config_filename = new_project_dir.path + '/' + config_.project_filename
-    if os.path.isfile(new_config_filename):
-        shellmatic_.LoadJson(new_config_filename)
-        console_.Print('%s: Loading configuration.' % new_config_filename)
 
-    # Change directory to the project.
-    #envout_.Call('cdd %(new_project_dir)s' % locals())
+def Run(console_, shellmatic_, config_, name, *command):
+    """
+    Runs a command in a project's environment (see workon), leaving the current one unchanged.
 
-    # Generate the batch script
-    batch_contents = shellmatic_.AsBatch(console_)
-    if test:
-        console_.Print(batch_contents, indent=1)
-    else:
-        CreateFile(config_.batch_filename, batch_contents)
+        ii run <name> -- <command>
+
+    :param name: The project name.
+    :param command: The command line.
+    """
+    activated = shellmatic_.Workon(
+        console_,
+        name,
+        config_filename=config_.project_filename,
+        cache_filename=os.path.expandvars(config_.projects_cache_filename),
+    )
+    if not activated:
+        return 1
+    return shellmatic_.Run(command, environ=os.environ)
+
+
+def Projects(console_, shellmatic_, config_, prefix=''):
+    """
+    Lists the projects with a virtualenv starting with the prefix. Fast enough for completion.
+
+    :param prefix: The project name prefix.
+    """
+    index = shellmatic_.ProjectIndex(
+        os.path.expandvars(config_.projects_index_filename),
+        config_filename=config_.project_filename,
+    )
+    for i_name in index.Complete(prefix):
+        console_.Print(i_name)
+
+
+def Doctor(console_, shellmatic_, config_, name='PATH', optimize=False, test=False):
+    """
+    Lists the missing and duplicate directories of a path-list variable of the current environment.
+
+    :param name: The path-list variable.
+    :param optimize: Removes those directories from the variable.
+    """
+    paths = [i for i in os.environ.get(name, '').split(os.pathsep) if i]
+    report = shellmatic_.PathListValue.Doctor(paths, stat_cache={})
+
+    problems = [(i, problem) for (i, problem) in report if problem is not None]
+    for i_path, i_problem in problems:
+        console_.Item('%s: %s' % (i_problem, i_path.AsPrint()))
+    console_.Print('%d of %d paths with problems.' % (len(problems), len(report)))
+
+    if optimize:
+        # The paths as found, literal: a path-list would drop more duplicates than reported.
+        paths = [i for (i, (_path, problem)) in zip(paths, report) if problem is None]
+        shellmatic_.EnvironmentSet('text:nodep:' + name, os.pathsep.join(paths))
+        batch_contents = _GenerateScript(shellmatic_, config_)
+        _OutputBatch(console_, config_, batch_contents, test)
+
+
+def Executables(console_, shellmatic_, config_, shims=False, test=False):
+    """
+    Lists the executables in PATH shadowed by others with the same name, the first being the one
+    that runs.
+
+    :param shims: Creates launchers for the executables in a single directory (see
+        Config.shims_dir), placed first in PATH: commands are found in one lookup.
+    """
+    shims_dir = os.path.normcase(os.path.expandvars(config_.shims_dir))
+    paths = [
+        i
+        for i in os.environ.get('PATH', '').split(os.pathsep)
+        if os.path.normcase(i) != shims_dir
+    ]
+    index = shellmatic_.ExecutableIndex(
+        os.path.expandvars(config_.executables_index_filename),
+        paths,
+    )
+
+    for i_command, i_executables in index.GetShadowed():
+        console_.Item(i_command)
+        for j_executable in i_executables:
+            console_.Item(j_executable, indent=1)
+
+    if shims:
+        count = index.CreateShims(shims_dir)
+        console_.Print('%d shims updated in %s' % (count, shims_dir))
+        shellmatic_.EnvironmentSet('pathlist:PATH', [shims_dir] + paths)
+        batch_contents = _GenerateScript(shellmatic_, config_)
+        _OutputBatch(console_, config_, batch_contents, test)
+
+
+def Serve(console_, config_):
+    """
+    Serves the most common commands (reset, load, set, workon) to "ii", keeping the loaded
+    configurations, the projects cache and index and the other state files warm.
+
+    "ii" uses the server when SHELLMATIC_SERVER is set with its address, and runs the commands
+    itself if the server is not running.
+    """
+    from contextlib import closing
+    from multiprocessing import AuthenticationError
+    from multiprocessing.connection import Listener
+
+    address = config_.server_address
+    if os.name != 'nt' and os.path.exists(address):
+        # Socket left behind by a killed server.
+        os.remove(address)
+    listener = Listener(str(address), authkey=_GetServerKey(config_, create=True))
+    console_.Print('Serving on %s' % address)
+    try:
+        while True:
+            try:
+                connection = listener.accept()
+            except (AuthenticationError, EOFError, OSError):
+                # Rejected or gone before the handshake.
+                continue
+            with closing(connection):
+                _ServeConnection(connection)
+    finally:
+        listener.close()
+
+
+def _GetServerKey(config_, create=False):
+    '''
+    Returns the key shared between the server and its clients, authenticating both sides.
+
+    :param bool create:
+        If True creates a new key, readable only by the user.
+    :return bytes|None:
+        None if there is no key (no server was ever started).
+    '''
+    filename = os.path.expandvars(config_.server_key_filename)
+    if create:
+        key = os.urandom(32)
+        fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as key_file:
+            key_file.write(key)
+        return key
+    try:
+        with open(filename, 'rb') as key_file:
+            return key_file.read()
+    except (IOError, OSError):
+        return None
+
+
+def _ServeConnection(connection):
+    '''
+    Executes one command line received from ClientMain, in the client environment and current
+    directory, sending back if it was handled, its output and its eval mode script.
+    '''
+    import io
+    import traceback
+
+    global _script_stream
+
+    try:
+        argv, environ, cwd = connection.recv()
+    except (EOFError, OSError):
+        # The client is gone.
+        return
+    stream = io.StringIO()
+    _script_stream = io.StringIO()
+    old_environ = dict(os.environ)
+    old_cwd = os.getcwd()
+    os.environ.clear()
+    os.environ.update(environ)
+    try:
+        os.chdir(cwd)
+        handled = FastMain(argv, _FastConsole(stream))
+    except Exception:
+        handled = True
+        stream.write(traceback.format_exc())
+    finally:
+        os.environ.clear()
+        os.environ.update(old_environ)
+        os.chdir(old_cwd)
+        script = _script_stream.getvalue()
+        _script_stream = None
+    try:
+        connection.send((handled, stream.getvalue(), script))
+    except (EOFError, OSError):
+        pass
+
+
+def ClientMain(argv, console_=None):
+    '''
+    Executes the command line on the shellmatic server (see Serve).
+
+    :return bool:
+        False if there is no server running or the command line must be handled in-process.
+    '''
+    from contextlib import closing
+    from multiprocessing.connection import Client
+
+    if argv and argv[0] in LOCAL_COMMANDS:
+        return False
+    config_ = Config()
+    key = _GetServerKey(config_)
+    if key is None:
+        return False
+    try:
+        connection = Client(str(config_.server_address), authkey=key)
+    except EnvironmentError:
+        return False
+    environ = dict(os.environ)
+    # The BATCH file of this shell, not of the server.
+    environ['SHELLMATIC_BATCH'] = config_.batch_filename
+    with closing(connection):
+        connection.send((argv, environ, os.getcwd()))
+        handled, output, script = connection.recv()
+    (console_ or _FastConsole()).Print(output, newlines=0)
+    if script:
+        _FastConsole(_script_stream).Write(script)
+    return handled
+
+
+def CreateApp():
+    '''
+    Creates the full (clikit) application.
+
+    :return clikit.app.App:
+    '''
+    from clikit.app import App
+
+    app = App('shellmatic', 'Automatic Shell.')
+    app.Fixture(Config)
+    app.Fixture(Shellmatic)
+    app(Reset)
+    app(Analyze)
+    app(List)
+    app(Load)
+    app(Set)
+    app(alias=('activate', 'wo'))(Workon)
+    app(Deactivate)
+    app(Run)
+    app(Prebuild)
+    app(Projects)
+    app(Doctor)
+    app(Executables)
+    app(Serve)
+    return app
+
+
+class _FastConsole(object):
+    '''
+    The subset of clikit.console.Console used by the FAST_COMMANDS.
+    '''
+
+    def __init__(self, stream=None):
+        self._stream = stream or sys.stdout
+
+    def Print(self, message='', indent=0, newlines=1):
+        import re
+        import six
+
+        # Drops clikit color markup: <green>text</>
+        message = re.sub(r'</?[a-z]*>', '', six.text_type(message))
+        message = '\n'.join(['    ' * indent + i for i in message.split('\n')])
+        self.Write(message + '\n' * newlines)
+
+    def Write(self, text):
+        '''
+        Writes the text as is.
+
+        :param unicode text:
+        '''
+        import six
+
+        if six.PY2 and isinstance(self._stream, file):
+            text = text.encode(self._stream.encoding or 'UTF-8', 'replace')
+        self._stream.write(text)
+
+    def Item(self, message, indent=0, newlines=1):
+        self.Print('- ' + message, indent=indent, newlines=newlines)
+
+
+FAST_COMMANDS = {
+    'reset' : Reset,
+    'load' : Load,
+    'set' : Set,
+    'workon' : Workon,
+    'activate' : Workon,
+    'wo' : Workon,
+    'deactivate' : Deactivate,
+    'run' : Run,
+    'projects' : Projects,
+    'doctor' : Doctor,
+    'executables' : Executables,
+}
+
+# Commands executed by "ii" itself, never by the server: they run in the caller console.
+LOCAL_COMMANDS = {'run'}
+
+# Commands whose output is not a BATCH script: stdout is not reserved in eval mode. ii.bat executes
+# them directly.
+OUTPUT_COMMANDS = {'run', 'projects', 'serve'}
+
+# The code flag of functions with *args.
+CO_VARARGS = 0x04
+
+def FastMain(argv, console_=None):
+    '''
+    Executes one of the FAST_COMMANDS without the full application.
+
+    Supports positional arguments, --option=value and --flag (for boolean options). Arguments after
+    "--" are all positional, passed to the command *args.
+
+    :param list(unicode) argv:
+    :param console_:
+        Defaults to a console printing to stdout.
+    :return bool:
+        False if the command line must be handled by the full application: any other command,
+        help, or arguments not matching the command.
+    :raises SystemExit:
+        With the command exit code, if not zero (eg.: run).
+    '''
+    command = FAST_COMMANDS.get(argv[0]) if argv else None
+    if command is None:
+        return False
+
+    # Skips the fixtures: console_, shellmatic_ and config_
+    code = command.__code__
+    params = code.co_varnames[3:code.co_argcount]
+    defaults = dict(zip(reversed(params), reversed(command.__defaults__ or ())))
+    varargs = code.co_flags & CO_VARARGS
+
+    args = []
+    kwargs = {}
+    for i_index, i_arg in enumerate(argv[1:]):
+        if i_arg == '--' and varargs:
+            args += argv[i_index + 2:]
+            break
+        if not i_arg.startswith('-'):
+            args.append(i_arg)
+            continue
+        name, sep, value = i_arg[2:].partition('=')
+        name = name.replace('-', '_')
+        if not i_arg.startswith('--') or name not in defaults:
+            return False
+        if isinstance(defaults[name], bool):
+            if sep:
+                return False
+            value = True
+        elif not sep:
+            return False
+        kwargs[name] = value
+
+    positional = params[:len(args)]
+    if (len(args) > len(params) and not varargs) or set(kwargs).intersection(positional):
+        return False
+    if any(isinstance(defaults.get(i), bool) for i in positional):
+        return False
+    if set(params).difference(positional, kwargs, defaults):
+        return False
+
+    retcode = command(console_ or _FastConsole(), Shellmatic(), Config(), *args, **kwargs)
+    if retcode:
+        sys.exit(retcode)
+    return True
+
+
+def _GetArgv():
+    '''
+    :return list(unicode):
+        The command line arguments, without the program name.
+    '''
+    if sys.version_info[0] == 2:
+        # Python 2 arguments are bytes, lossy on Windows: ben10 obtains the unicode command line.
+        from ben10.execute import GetUnicodeArgv
+        return GetUnicodeArgv()[1:]
+    return sys.argv[1:]
 
 
 if __name__ == '__main__':
-    argv = GetUnicodeArgv()[1:]
-    app.Main(argv)
+    argv = _GetArgv()
+    command = argv[0] if argv else None
+    if Config().batch_filename == '-' and command not in OUTPUT_COMMANDS:
+        # Eval mode: stdout is reserved for the BATCH script.
+        _script_stream, sys.stdout = sys.stdout, sys.stderr
+    if os.environ.get('SHELLMATIC_SERVER') and ClientMain(argv):
+        pass
+    elif not FastMain(argv):
+        CreateApp().Main(argv)
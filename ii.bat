@@ -1,9 +1,11 @@
 @echo off
 set SHELLMATIC_EXE=python "%~dp0_ii.py"
-set SHELLMATIC_BATCH=%TEMP%\.shellmatic.bat
-%SHELLMATIC_EXE% %*
+set SHELLMATIC_BATCH=-
+for %%c in (run projects serve) do if /i "%~1"=="%%c" goto direct
+
+rem The output is the BATCH script to execute.
+for /f "delims=" %%i in ('"%SHELLMATIC_EXE% %*"') do call %%i
+goto :eof
 
-@if exist "%SHELLMATIC_BATCH%" (
-    call "%SHELLMATIC_BATCH%"
-    del /q "%SHELLMATIC_BATCH%"
-)
+:direct
+%SHELLMATIC_EXE% %*
@@ -2,11 +2,12 @@ from __future__ import unicode_literals
 from ben10.filesystem import GetFileContents, NormalizePath, StandardizePath, CreateFile
 from ben10.foundation.decorators import Comparable
 from ben10.foundation.odict import odict
-from ben10.foundation.reraise import Reraise
 from ben10.foundation.types_ import CheckType
 import ntpath
 import os
+import re
 import six
+import weakref
 
 
 LOGO = r"""
@@ -30,6 +31,21 @@ class EnvVarTypeError(TypeError):
     '''
 
 
+class CyclicDependencyError(ValueError):
+    '''
+    The environment variables references form one or more cycles, so there is no order to define
+    them.
+
+    :ivar list(list(unicode)) cycles:
+        Each cycle as a path of variable names, starting and ending on the same variable.
+    '''
+
+    def __init__(self, cycles):
+        self.cycles = cycles
+        cycles = '; '.join([' -> '.join(i) for i in cycles])
+        ValueError.__init__(self, 'Cyclic dependency detected: %(cycles)s.' % locals())
+
+
 #===================================================================================================
 # ConfigFile
 #===================================================================================================
@@ -39,17 +55,91 @@ class Shellmatic(object):
     '''
 
     class ValueType(object):
-        pass
+        '''
+        Base class for the environment variables values.
+
+        Values are parsed once into a sequence of tokens alternating literals (even positions) and
+        environment variables references (odd positions), as written. Eg.:
+            '$ALPHA/${BRAVO}' -> ('', '$ALPHA', '/', '${BRAVO}', '')
+
+        Values are immutable (except for PathListValue, a container) and slot based: one is created
+        for each environment variable.
+        '''
+
+        __slots__ = ()
+
+        # The references recognized by os.path.expandvars on each platform.
+        POSIX_REFERENCE_RE = re.compile(r'(\$\w+|\$\{\w+\})')
+        WINDOWS_REFERENCE_RE = re.compile(r'(\$\w+|\$\{\w+\}|%\w+%)')
+        REFERENCE_RE = WINDOWS_REFERENCE_RE if os.name == 'nt' else POSIX_REFERENCE_RE
+
+        @classmethod
+        def _Tokenize(cls, text):
+            '''
+            :param unicode text:
+            :return tuple(unicode):
+            '''
+            return tuple(cls.REFERENCE_RE.split(text))
+
+        @classmethod
+        def _GetNames(cls, tokens):
+            '''
+            :param tuple(unicode) tokens:
+            :return tuple(unicode):
+                The names of the variables referenced by the tokens: ${name} -> name
+            '''
+            return tuple(i.strip('${}%') for i in tokens[1::2])
+
+        @classmethod
+        def _BatchTokens(cls, tokens):
+            '''
+            Returns the tokens with the references platformized: $name -> %NAME%
+
+            :param tuple(unicode) tokens:
+            :return unicode:
+            '''
+            if len(tokens) == 1:
+                return tokens[0]
+            result = list(tokens)
+            result[1::2] = ['%' + i.upper() + '%' for i in cls._GetNames(tokens)]
+            return ''.join(result)
+
+        @classmethod
+        def _ExpandTokens(cls, tokens, environ=None):
+            '''
+            Returns the tokens with the references expanded.
+
+            As os.path.expandvars, references to undefined variables are left unchanged.
+
+            :param tuple(unicode) tokens:
+            :param dict environ:
+                Defaults to os.environ.
+            :return unicode:
+            '''
+            if len(tokens) == 1:
+                return tokens[0]
+            if environ is None:
+                environ = os.environ
+            result = list(tokens)
+            # References are case insensitive: the scripts reference the upper case names.
+            result[1::2] = [
+                environ.get(i_name, environ.get(i_name.upper(), i_token))
+                for (i_name, i_token) in zip(cls._GetNames(tokens), tokens[1::2])
+            ]
+            return ''.join(result)
 
     @Comparable
     class TextValue(ValueType):
 
         TYPENAME = 'text'
 
+        __slots__ = ('__text', '__tokens')
+
         def __init__(self, text):
             CheckType(text, six.text_type)
             self.__text = text # .decode('ascii')
             CheckType(self.__text, six.text_type)
+            self.__tokens = self._Tokenize(self.__text)
 
         def _cmpkey(self):
             '''
@@ -63,8 +153,21 @@ class Shellmatic(object):
         def __repr__(self):
             return '<TextValue %s>' % self.__str__()
 
-        def ExpandVars(self):
-            self.__text = os.path.expandvars(self.__text)
+        def ExpandVars(self, environ=None):
+            '''
+            :param dict environ:
+                Defaults to os.environ.
+            :return TextValue:
+                This text with the environment variables references expanded.
+            '''
+            return Shellmatic.TextValue(self._ExpandTokens(self.__tokens, environ))
+
+        def GetReferences(self):
+            '''
+            :return tuple(unicode):
+                The names of the environment variables referenced by this value.
+            '''
+            return self._GetNames(self.__tokens)
 
         def AsList(self):
             return [self.__text]
@@ -75,6 +178,14 @@ class Shellmatic(object):
         def AsPrint(self):
             return self.__text
 
+        def AsEnviron(self, environ):
+            '''
+            :param Environ environ:
+            :return unicode:
+                The value as set in the given environment.
+            '''
+            return self.__text
+
         def AsBatch(self, expandvars=False, nodep=False):
             '''
             :param bool expandvars:
@@ -82,20 +193,15 @@ class Shellmatic(object):
                 If False platformize environment variables references.
             '''
             if expandvars:
-                result = os.path.expandvars(self.__text)
+                result = self._ExpandTokens(self.__tokens)
             elif nodep:
                 result = self.__text
             else:
-                result = self._EnvVarReferencesOut(self.__text)
+                result = self._BatchTokens(self.__tokens)
             return result
 
         def IsDir(self):
-            return os.path.isdir(os.path.expandvars(self.__path))
-
-        @classmethod
-        def _EnvVarReferencesOut(cls, value):
-            import re
-            return re.sub('\$(\w+)', lambda x: '%' + x.group(1).upper() + '%', value)
+            return os.path.isdir(self._ExpandTokens(self.__tokens))
 
 
     @Comparable
@@ -103,15 +209,33 @@ class Shellmatic(object):
 
         TYPENAME = 'path'
 
-        def __init__(self, path):
-            self.__path = StandardizePath(path, strip=True)
-            assert isinstance(self.__path, six.text_type)
+        __slots__ = ('__path', '__key', '__tokens', '__batch', '__weakref__')
+
+        # Flyweight pool: PathValue instances are immutable so equal paths share the same instance,
+        # living only while referenced.
+        _pool = weakref.WeakValueDictionary()
+
+        def __new__(cls, path):
+            path = StandardizePath(path, strip=True)
+            assert isinstance(path, six.text_type)
+            result = cls._pool.get(path)
+            if result is None:
+                result = super(Shellmatic.PathValue, cls).__new__(cls)
+                result.__path = path
+                result.__key = StandardizePath(ntpath.normcase(path))
+                result.__tokens = cls._Tokenize(path)
+                result.__batch = None
+                cls._pool[path] = result
+            return result
 
         def _cmpkey(self):
             '''
             Implements Comparable._cmpkey
             '''
-            return StandardizePath(ntpath.normcase(self.__path))
+            return self.__key
+
+        def __hash__(self):
+            return hash(self.__key)
 
         def __str__(self):
             return self.AsPrint()
@@ -121,10 +245,24 @@ class Shellmatic(object):
 
         @property
         def path(self):
-            return os.path.expandvars(self.__path)
+            return self._ExpandTokens(self.__tokens)
 
-        def ExpandVars(self):
-            self.__path = os.path.expandvars(self.__path)
+        def ExpandVars(self, environ=None):
+            '''
+            :param dict environ:
+                Defaults to os.environ.
+            :return PathValue:
+                This path with the environment variables references expanded. Since PathValue is
+                immutable the result is another instance.
+            '''
+            return Shellmatic.PathValue(self._ExpandTokens(self.__tokens, environ))
+
+        def GetReferences(self):
+            '''
+            :return tuple(unicode):
+                The names of the environment variables referenced by this value.
+            '''
+            return self._GetNames(self.__tokens)
 
         def AsList(self):
             return [self.__path.lower()]
@@ -135,6 +273,14 @@ class Shellmatic(object):
         def AsPrint(self):
             return self.__path
 
+        def AsEnviron(self, environ):
+            '''
+            :param Environ environ:
+            :return unicode:
+                The path as written in the given environment platform.
+            '''
+            return environ.FormatPath(self.__path)
+
         def AsBatch(self, expandvars=False, nodep=False):
             '''
             :param bool expandvars:
@@ -142,17 +288,30 @@ class Shellmatic(object):
                 If False platformize environment variables references.
             '''
             if expandvars:
-                result = os.path.expandvars(self.__path)
+                result = self._ExpandTokens(self.__tokens)
             elif nodep:
                 result = ntpath.normpath(self.__path)
             else:
-                result = ntpath.normpath(self.__path)
-                result = ntpath.normcase(result)
-                result = self._PlatformizeEnvVarsReferences(result)
+                # Normalization must see the whole path (normpath collapses "..") so the batch
+                # text is tokenized on its own, once.
+                if self.__batch is None:
+                    result = ntpath.normcase(ntpath.normpath(self.__path))
+                    self.__batch = self._BatchTokens(self._Tokenize(result))
+                result = self.__batch
             return result
 
-        def IsDir(self):
-            return os.path.isdir(self.path)
+        def IsDir(self, stat_cache=None):
+            '''
+            :param dict(unicode, bool) stat_cache:
+                Results by expanded path, checked only once. Safe to share among threads.
+            '''
+            path = self.path
+            if stat_cache is None:
+                return os.path.isdir(path)
+            result = stat_cache.get(path)
+            if result is None:
+                result = stat_cache[path] = os.path.isdir(path)
+            return result
 
         def IsFile(self):
             return os.path.isfile(self.path)
@@ -160,50 +319,100 @@ class Shellmatic(object):
         def CreateFile(self, contents, encoding=None):
             return CreateFile(self.path, contents, encoding=encoding)
 
-        @classmethod
-        def _PlatformizeEnvVarsReferences(cls, value):
-            import re
-            return re.sub('\$(\w+)', lambda x: '%' + x.group(1).upper() + '%', value)
-
 
     @Comparable
     class PathListValue(ValueType):
 
         TYPENAME = 'pathlist'
 
+        __slots__ = ('__pathlist', '__tree')
+
         def __init__(self, value):
-            self.__pathlist = []
+            # The paths, in order, indexed by their comparison key.
+            self.__pathlist = odict()
+            # The comparison keys split in components: {component : {...}}. The key of a path is
+            # stored under the None entry of its last component node.
+            self.__tree = {}
             if not isinstance(value, (list, tuple)):
                 value = value.split(ntpath.pathsep)
             for i in value:
                 # Remove empty values and avoid duplicate values
                 if not i:
                     continue
-                path = Shellmatic.PathValue(i)
-                if path in self.__pathlist:
-                    continue
-                self.__pathlist.append(path)
+                if not isinstance(i, Shellmatic.PathValue):
+                    i = Shellmatic.PathValue(i)
+                self._Add(i)
+
+        def _Add(self, path):
+            key = path._cmpkey()
+            if key in self.__pathlist:
+                return
+            self.__pathlist[key] = path
+            node = self.__tree
+            for i in key.split('/'):
+                node = node.setdefault(i, {})
+            node[None] = key
+
+        def _Discard(self, key):
+            del self.__pathlist[key]
+            nodes = [self.__tree]
+            components = key.split('/')
+            for i in components:
+                nodes.append(nodes[-1][i])
+            del nodes[-1][None]
+            # Prune the emptied branch.
+            for i_node, i_component in reversed(list(zip(nodes[:-1], components))):
+                if i_node[i_component]:
+                    break
+                del i_node[i_component]
 
         def _cmpkey(self):
             '''
             Implements Comparable._cmpkey
             '''
-            return [i._cmpkey() for i in self.__pathlist]
+            return list(self.__pathlist.keys())
 
         def __str__(self):
-            return '\n'.join(map(str, self.__pathlist))
+            return '\n'.join(map(str, six.itervalues(self.__pathlist)))
 
         def __repr__(self):
             return '<PathListValue %s>' % self.__str__()
 
+        def __contains__(self, value):
+            if isinstance(value, six.text_type):
+                value = Shellmatic.PathValue(value)
+            return value._cmpkey() in self.__pathlist
+
+
+        def __iter__(self):
+            return six.itervalues(self.__pathlist)
+
+        def __len__(self):
+            return len(self.__pathlist)
+
 
-        def ExpandVars(self):
-            for i in self.pathlist:
-                i.ExpandVars()
+        def ExpandVars(self, environ=None):
+            '''
+            :param dict environ:
+                Defaults to os.environ.
+            :return PathListValue:
+                A new path-list with the environment variables references expanded.
+            '''
+            return Shellmatic.PathListValue([i.ExpandVars(environ) for i in self])
+
+        def GetReferences(self):
+            '''
+            :return tuple(unicode):
+                The names of the environment variables referenced by this value.
+            '''
+            result = ()
+            for i in six.itervalues(self.__pathlist):
+                result += i.GetReferences()
+            return result
 
         def AsList(self):
             result = []
-            for i in self.__pathlist:
+            for i in six.itervalues(self.__pathlist):
                 result += i.AsList()
             return result
 
@@ -211,7 +420,17 @@ class Shellmatic(object):
             return self.AsList()
 
         def AsPrint(self, prefix='\n   '):
-            return prefix + prefix.join(map(six.text_type, self.__pathlist))
+            return prefix + prefix.join(map(six.text_type, six.itervalues(self.__pathlist)))
+
+        def AsEnviron(self, environ):
+            '''
+            :param Environ environ:
+            :return unicode:
+                The path-list as written in the given environment platform.
+            '''
+            return environ.pathsep.join(
+                [i.AsEnviron(environ) for i in six.itervalues(self.__pathlist)]
+            )
 
         def AsBatch(self, expandvars=False, nodep=False):
             '''
@@ -219,7 +438,10 @@ class Shellmatic(object):
                 If True expand environment variables references in the returning value.
                 If False platformize environment variables references.
             '''
-            result = [i.AsBatch(expandvars=expandvars, nodep=nodep) for i in self.__pathlist]
+            result = [
+                i.AsBatch(expandvars=expandvars, nodep=nodep)
+                for i in six.itervalues(self.__pathlist)
+            ]
             return ntpath.pathsep.join(result)
 
         def Remove(self, value):
@@ -227,19 +449,119 @@ class Shellmatic(object):
                 value = Shellmatic.PathValue(value)
             CheckType(value, Shellmatic.PathValue)
 
-            new_pathlist = self.__pathlist[:]
-            try:
-                new_pathlist.remove(value)
-            except ValueError as e:
-                pathlist_items = '\n  - '.join(map(str, new_pathlist))
-                Reraise(
-                    e,
+            key = value._cmpkey()
+            if key not in self.__pathlist:
+                pathlist_items = '\n  - '.join(map(str, six.itervalues(self.__pathlist)))
+                raise ValueError(
                     'While trying to remove value "%s" from path-list:\n  - %s' % (
                         value,
                         pathlist_items
                     )
                 )
-            self.__pathlist = new_pathlist
+            self._Discard(key)
+
+        def RemoveTree(self, value):
+            '''
+            Removes the given path and all paths under it.
+
+            :param unicode|PathValue value:
+            :return list(PathValue):
+                The removed paths, in their original order.
+            '''
+            if isinstance(value, six.text_type):
+                value = Shellmatic.PathValue(value)
+            CheckType(value, Shellmatic.PathValue)
+
+            node = self.__tree
+            for i in value._cmpkey().split('/'):
+                node = node.get(i)
+                if node is None:
+                    return []
+
+            keys = set()
+            pending = [node]
+            while pending:
+                i_node = pending.pop()
+                for j_component, j_child in six.iteritems(i_node):
+                    if j_component is None:
+                        keys.add(j_child)
+                    else:
+                        pending.append(j_child)
+
+            result = [i for (k, i) in six.iteritems(self.__pathlist) if k in keys]
+            for i in result:
+                self._Discard(i._cmpkey())
+            return result
+
+        PROBLEM_MISSING = 'missing'
+        PROBLEM_DUPLICATE = 'duplicate'
+
+        DOCTOR_THREADS = 16
+
+        @classmethod
+        def Doctor(cls, paths, environ=None, stat_cache=None, threads=DOCTOR_THREADS):
+            '''
+            Checks the paths of a path-list as the shell sees them, finding the missing and duplicate
+            directories every command lookup walks through.
+
+            The directories are checked concurrently since each check may block (eg.: network
+            drives).
+
+            :param list(unicode|PathValue) paths:
+                The paths, possibly with duplicates (eg.: os.environ['PATH'] split). Empty paths are
+                ignored.
+            :param dict environ:
+                Expands the paths environment variables references. Defaults to os.environ.
+            :param dict(unicode, bool) stat_cache:
+                See PathValue.IsDir.
+            :param int threads:
+            :return list(tuple(PathValue, unicode)):
+                The paths, in order, with their problem: None, PROBLEM_MISSING or PROBLEM_DUPLICATE
+                (expands to the same directory of a previous path).
+            '''
+            from multiprocessing.pool import ThreadPool
+
+            if stat_cache is None:
+                stat_cache = {}
+            paths = [
+                i if isinstance(i, Shellmatic.PathValue) else Shellmatic.PathValue(i)
+                for i in paths
+                if i
+            ]
+            expanded = [i.ExpandVars(environ) for i in paths]
+
+            pending = list({i for i in expanded if i.path not in stat_cache})
+            if len(pending) > 1 and threads > 1:
+                pool = ThreadPool(min(threads, len(pending)))
+                try:
+                    pool.map(lambda x: x.IsDir(stat_cache), pending)
+                finally:
+                    pool.close()
+
+            result = []
+            keys = set()
+            for i_path, i_expanded in zip(paths, expanded):
+                # The same directory for the current platform (case sensitive on POSIX).
+                key = os.path.normcase(os.path.normpath(i_expanded.path))
+                if key in keys:
+                    problem = cls.PROBLEM_DUPLICATE
+                elif not i_expanded.IsDir(stat_cache):
+                    problem = cls.PROBLEM_MISSING
+                else:
+                    problem = None
+                keys.add(key)
+                result.append((i_path, problem))
+            return result
+
+        @classmethod
+        def Optimize(cls, paths, environ=None, stat_cache=None, threads=DOCTOR_THREADS):
+            '''
+            :return list(PathValue):
+                The given paths without the problems found by Doctor (same parameters). Not a
+                PathListValue: it would also drop the paths differing only in case on POSIX.
+            '''
+            report = cls.Doctor(paths, environ=environ, stat_cache=stat_cache, threads=threads)
+            return [i for (i, problem) in report if problem is None]
 
 
 
@@ -281,15 +603,112 @@ class Shellmatic(object):
             'PYTHONPATH' : {TYPE_PATHLIST},
         }
 
-        def __init__(self, name, value):
-            self.flags, self.name = self._SplitName(name)
+        # Flags are stored compactly: the well known flags (types and nodep) as bits of an integer
+        # mask and any other (user) flags as an interned sorted tuple.
+        FLAG_BITS = {
+            TYPE_TEXT : 1 << 0,
+            TYPE_PATH : 1 << 1,
+            TYPE_PATHLIST : 1 << 2,
+            FLAG_NODEP : 1 << 3,
+        }
+        _user_flags_pool = {}
+
+        __slots__ = ('name', '_value', '_flags_mask', '_user_flags', '_lazy')
+
+        def __init__(self, name, value, lazy=False):
+            '''
+            :param unicode name:
+                The variable name, prefixed by flags. Eg.: windows:path:HOME
+            :param unicode|ValueType value:
+            :param bool lazy:
+                If True the variable type and value are only resolved when first used. For
+                variables captured from the process environment, most never used.
+            '''
+            flags, self.name = self._SplitName(name)
+            self._flags_mask, self._user_flags = self._EncodeFlags(flags)
+            self._value = value
+            self._lazy = True
+            if not lazy:
+                self._Resolve()
+
+
+        def _Resolve(self):
+            '''
+            Resolves the variable type, from the default flags if no type is given, and its value.
+            '''
+            flags = self._DecodeFlags()
 
             # Set a type as a flag IF any type were set.
-            if not self.flags.intersection(set(self.TYPES)):
-                new_flags = self._GetDefaultFlags(self.name, value)
-                self.flags.update(new_flags)
+            if not flags.intersection(set(self.TYPES)):
+                new_flags = self._GetDefaultFlags(self.name, self._value)
+                flags.update(new_flags)
+                self._flags_mask, self._user_flags = self._EncodeFlags(flags)
+
+            self._value = self._ValueIn(flags, self.name, self._value)
+            self._lazy = False
+
+
+        @property
+        def value(self):
+            '''
+            :return ValueType:
+            '''
+            if self._lazy:
+                self._Resolve()
+            return self._value
+
+
+        @classmethod
+        def _EncodeFlags(cls, flags):
+            '''
+            :param set(unicode) flags:
+            :return int, tuple(unicode):
+                The mask of the well known flags and the (interned) tuple of the user flags.
+            '''
+            mask = 0
+            user_flags = []
+            for i in flags:
+                bit = cls.FLAG_BITS.get(i)
+                if bit is None:
+                    user_flags.append(i)
+                else:
+                    mask |= bit
+            user_flags = tuple(sorted(user_flags))
+            return mask, cls._user_flags_pool.setdefault(user_flags, user_flags)
+
+
+        def _DecodeFlags(self):
+            '''
+            :return set(unicode):
+            '''
+            result = {i for (i, j) in six.iteritems(self.FLAG_BITS) if self._flags_mask & j}
+            result.update(self._user_flags)
+            return result
+
 
-            self.value = self._ValueIn(self.flags, self.name, value)
+        @property
+        def flags(self):
+            '''
+            :return frozenset(unicode):
+            '''
+            if self._lazy:
+                self._Resolve()
+            return frozenset(self._DecodeFlags())
+
+
+        def HasFlag(self, flag):
+            '''
+            Checks for a flag without decoding all flags.
+
+            :param unicode flag:
+            :return bool:
+            '''
+            bit = self.FLAG_BITS.get(flag)
+            if bit is None:
+                return flag in self._user_flags
+            if self._lazy:
+                self._Resolve()
+            return bool(self._flags_mask & bit)
 
 
         @classmethod
@@ -332,8 +751,54 @@ class Shellmatic(object):
                 If False generate a script that sets the value to the environment variable.
             :return unicode:
             '''
+            return self._AsBatchLine(self.value, append)
+
+
+        def GetDelta(self, environ, append=False):
+            '''
+            Returns the value to set (or append) to change the given environment, or None if the
+            environment already have this value. Appending to a path-list only adds the paths
+            missing from the environment.
+
+            :param Shellmatic.Environ environ:
+                Updated with the results: the expanded values, as set in the environment platform.
+            :param bool append:
+            :return ValueType|None:
+            '''
+            nodep = self.HasFlag(self.FLAG_NODEP)
+            value = self.value
+            current = environ.get(self.name)
+
+            if append and current is not None and isinstance(value, Shellmatic.PathListValue):
+                current_keys = set(environ.GetPathKeys(current))
+                value = Shellmatic.PathListValue([
+                    i
+                    for i in value
+                    if environ.GetPathKey(i.ExpandVars(environ).AsEnviron(environ))
+                    not in current_keys
+                ])
+                if not value:
+                    return None
+
+            expanded = value if nodep else value.ExpandVars(environ)
+            text = expanded.AsEnviron(environ)
+            if append:
+                environ[self.name] = current + environ.pathsep + text if current else text
+            else:
+                if current is not None and environ.IsSame(current, text, value.TYPENAME):
+                    return None
+                environ[self.name] = text
+            return value
+
+
+        def _AsBatchLine(self, value, append):
+            '''
+            :param ValueType value:
+            :param bool append:
+            :return unicode:
+            '''
             name = self.name
-            value = self.value.AsBatch(nodep=self.FLAG_NODEP in self.flags)
+            value = value.AsBatch(nodep=self.HasFlag(self.FLAG_NODEP))
             if append:
                 format = 'set %(name)s=%%%(name)s%%;%(value)s'
             else:
@@ -351,17 +816,26 @@ class Shellmatic(object):
         def GetDependencies(self):
             '''
             :return set(unicode):
+                The names (upper case) of the variables referenced. Lazy variables are not resolved:
+                the references are scanned in their raw value.
             '''
-            import re
-
-            dependencies = []
-
-            if self.FLAG_NODEP in self.flags:
+            if not self._lazy:
+                if self.HasFlag(self.FLAG_NODEP):
+                    return set()
+                return {i.upper() for i in self.value.GetReferences()}
+
+            nodep = self._flags_mask & self.FLAG_BITS[self.FLAG_NODEP]
+            if not any(self._flags_mask & self.FLAG_BITS[i] for i in self.TYPES):
+                nodep = nodep or self.FLAG_NODEP in self.DEFAULT_FLAGS.get(self.name, ())
+            if nodep:
                 return set()
-
-            for i in self.value.AsList():
-                dependencies += re.findall('\$(\w+)', i)
-            return {i.upper() for i in dependencies}
+            value = self._value
+            if isinstance(value, Shellmatic.ValueType):
+                return {i.upper() for i in value.GetReferences()}
+            if not isinstance(value, six.string_types):
+                value = '\n'.join(value)
+            tokens = Shellmatic.ValueType._Tokenize(value)
+            return {i.upper() for i in Shellmatic.ValueType._GetNames(tokens)}
 
 
         @classmethod
@@ -405,180 +879,2359 @@ class Shellmatic(object):
                     flags.add(i)
             return flags, name
 
-    SECTION_ENVIRONMENT = 'environment'
-    ENVIRONMENT_FILENAME = '.shellmatic.json'
-
-    def __init__(self):
-        self.environment = odict()
-        self.alias = odict()
-        self.calls = odict()
-
 
-    def LoadEnvironment(self, environ=None):
+    class DependencyGraph(object):
         '''
-        Loads environment from the current environment.
+        Indexed dependency graph between environment variables names.
 
-        :param dict|None environ:
-            An alternative to os.environ. Used for testing purposes.
+        Only dependencies between the variables in the graph are considered: references to
+        undefined variables are left for the shell to solve.
         '''
-        def decode(text, encoding='ascii'):
-            if isinstance(text, six.text_type):
-                return text
-            return text.decode(encoding)
-
-        if environ is None:
-            environ = os.environ
-        environ = {decode(i) : decode(j) for (i,j) in six.iteritems(environ)}
-        for i_name, i_value in six.iteritems(environ):
-            self.EnvironmentSet('_environ:' + i_name, i_value)
-
-
-    def EnvironmentSet(self, name, value):
-        self.environment[name] = self.EnvVar(name, value)
 
+        def __init__(self, source):
+            '''
+            :param list(unicode, set(unicode)) source:
+                Pairs of variable name and its dependencies, in the preferred output order.
+            '''
+            self.names = [i_name for (i_name, _deps) in source]
+            self.index = {i_name : i for (i, i_name) in enumerate(self.names)}
+            self.dependencies = []
+            self.dependents = [[] for _i in self.names]
+            for i, (_name, i_deps) in enumerate(source):
+                deps = sorted({self.index[j] for j in i_deps if j in self.index} - {i})
+                self.dependencies.append(deps)
+                for j in deps:
+                    self.dependents[j].append(i)
+
+
+        def TopologicalSort(self):
+            '''
+            Returns the variables names sorted by dependency (Kahn).
 
-    def AsBatch(self, console_, append=False):
-        '''
-        :param clikit.Console console_:
-        :return unicode:
-        '''
+            The order is the same of sweeping the pending variables in the original order over and
+            over, emitting a variable as soon as all its dependencies were emitted (even if earlier
+            in the same sweep). Each variable "sweep" is computed from its dependencies so the whole
+            ordering is linear on the number of variables and dependencies.
 
-        def TopologicalSort(source):
+            :return list(unicode):
+            :raise CyclicDependencyError:
             '''
-            :param list(unicode, set(unicode)) source:
-            :return list(object):
+            from collections import deque
+
+            count = len(self.names)
+            pending = [len(i) for i in self.dependencies]
+            sweep = [0] * count
+            queue = deque([i for i in range(count) if not pending[i]])
+            visited = 0
+            while queue:
+                i = queue.popleft()
+                visited += 1
+                for j in self.dependents[i]:
+                    # A dependency placed after the dependent is only emitted on the next sweep.
+                    sweep[j] = max(sweep[j], sweep[i] + (1 if i > j else 0))
+                    pending[j] -= 1
+                    if not pending[j]:
+                        queue.append(j)
+
+            if visited < count:
+                raise CyclicDependencyError(self.GetCycles())
+
+            order = sorted(range(count), key=lambda x: (sweep[x], x))
+            return [self.names[i] for i in order]
+
+
+        def GetCycles(self):
             '''
-            defined = {i[0] for i in source}
-            pending = source[:]
-            emitted = []
-            while pending:
-                next_pending = []
-                next_emitted = []
-                for entry in pending:
-                    name, deps = entry
-                    deps.difference_update(set((name,)), emitted) # <-- pop self from dep
-                    if deps & defined:  # <-- consider a cycle only between defined variables
-                        next_pending.append(entry)
+            Returns one cycle for each strongly connected component of the graph (Tarjan).
+
+            :return list(list(unicode)):
+                Each cycle as a path of variable names starting and ending on the same variable.
+                Eg.: ['ALPHA', 'ZULU', 'ALPHA'] for ALPHA=$ZULU and ZULU=$ALPHA.
+            '''
+            order = {}
+            lowlink = {}
+            stack = []
+            on_stack = set()
+            components = []
+            for i_root in range(len(self.names)):
+                if i_root in order:
+                    continue
+                # Iterative version of the recursive Tarjan algorithm: long chains of variables must
+                # not hit the recursion limit.
+                work = [(i_root, 0)]
+                while work:
+                    node, pos = work.pop()
+                    if pos == 0:
+                        order[node] = lowlink[node] = len(order)
+                        stack.append(node)
+                        on_stack.add(node)
+                    deps = self.dependencies[node]
+                    while pos < len(deps):
+                        dep = deps[pos]
+                        pos += 1
+                        if dep not in order:
+                            work.append((node, pos))
+                            work.append((dep, 0))
+                            break
+                        if dep in on_stack:
+                            lowlink[node] = min(lowlink[node], order[dep])
                     else:
-                        yield name
-                        emitted.append(name) # <-- not required, but preserves original order
-                        next_emitted.append(name)
-                if not next_emitted:
-                    dep = ','.join(next_pending[0][-1])
-                    raise ValueError('Cyclic dependency detected: %(dep)s (dependency of %(name)s).' % locals())
-                pending = next_pending
-                emitted = next_emitted
-
-        # Groups env-vars by name
-        sources = {}
-        envvars = {}
-        for i_envvar in six.itervalues(self.environment):
-            sources.setdefault(i_envvar.name, set()).update(i_envvar.GetDependencies())
-            envvars.setdefault(i_envvar.name, []).append(i_envvar)
-        sources = sorted(sources.items())
+                        if lowlink[node] == order[node]:
+                            component = []
+                            while not component or component[-1] != node:
+                                component.append(stack.pop())
+                                on_stack.discard(component[-1])
+                            if len(component) > 1:
+                                components.append(component)
+                        if work:
+                            parent = work[-1][0]
+                            lowlink[parent] = min(lowlink[parent], lowlink[node])
 
-        result = []
-        seen = set()
-        for i_name in TopologicalSort(sources):
-            for j_envvar in envvars[i_name]:
-                do_append = append and self.EnvVar.TYPE_PATHLIST in j_envvar.flags
-                do_append = do_append or j_envvar.name in seen
-                result.append(j_envvar.AsBatch(append=do_append))
-                seen.add(j_envvar.name)
+            return [self._GetCyclePath(i) for i in sorted(components, key=min)]
 
-        return '\n'.join(result)
 
+        def _GetCyclePath(self, component):
+            '''
+            Returns the shortest cycle, inside the given component, passing by its first variable.
 
-    def LoadJson(self, filename, flags=()):
+            :param list(int) component:
+            :return list(unicode):
+            '''
+            from collections import deque
+
+            members = set(component)
+            start = min(component)
+            parents = {start : None}
+            queue = deque([start])
+            while queue:
+                i = queue.popleft()
+                if start in self.dependencies[i]:
+                    break
+                for j in self.dependencies[i]:
+                    if j in members and j not in parents:
+                        parents[j] = i
+                        queue.append(j)
+
+            path = [start]
+            while i is not None:
+                path.append(i)
+                i = parents[i]
+            path.reverse()
+            return [self.names[j] for j in path]
+
+
+    class ProjectIndex(object):
         '''
-        Loads the configuration from a JSON file.
+        A persistent index of the projects in $PROJECTS_DIR, for listing and completion.
 
-        :param unicode filename:
+        The index is revalidated using the directories modification times: the projects directory is
+        only listed again when projects are added or removed, and a project only scanned again when
+        its own directory changes (eg.: its virtualenv or configuration created or removed).
         '''
-        import json
-        from collections import OrderedDict
 
-        try:
-            data = json.loads(
-                GetFileContents(filename, encoding='UTF-8'),
-                object_pairs_hook=OrderedDict
+        VERSION = 1
+
+        def __init__(self, filename, projects_dir=None, config_filename=None):
+            '''
+            Loads the index, updating it (see Update).
+
+            :param unicode filename:
+                The index file.
+            :param unicode projects_dir:
+                Defaults to $PROJECTS_DIR.
+            :param unicode config_filename:
+                The project configuration filename. Defaults to Shellmatic.ENVIRONMENT_FILENAME.
+            '''
+            self.filename = filename
+            self.projects_dir = projects_dir or Shellmatic.PathValue('$PROJECTS_DIR').path
+            self.config_filename = config_filename or Shellmatic.ENVIRONMENT_FILENAME
+
+            # The projects directory modification time.
+            self._mtime = None
+            # {name : (mtime, project_dir, venv_home, scripts_dir, has_config)}. venv_home and
+            # scripts_dir are None for projects without a virtualenv.
+            self._projects = {}
+            # The projects with a virtualenv, sorted for completion: [(normcase(name), name)]
+            self._keys = []
+
+            self._Load()
+            self.Update()
+
+        def _Load(self):
+            data = Shellmatic._LoadMarshal(self.filename, self.VERSION)
+            if data is not None and data[:2] == (self.projects_dir, self.config_filename):
+                self._mtime, self._projects, self._keys = data[2:]
+
+        def _Save(self):
+            data = (
+                self.projects_dir,
+                self.config_filename,
+                self._mtime,
+                self._projects,
+                self._keys,
             )
-            items = data.get(self.SECTION_ENVIRONMENT, {})
-            for i_name, i_value in six.iteritems(items):
-                name = ':'.join(sorted(flags) + [i_name])
-                self.EnvironmentSet(name, i_value)
-        except Exception as e:
-            raise e
+            Shellmatic._SaveMarshal(self.filename, self.VERSION, data)
+
+        def _ScanProject(self, name, mtime):
+            project_dir = os.path.join(self.projects_dir, name)
+            children = {i[0] : i[1] for i in _ScanDir(project_dir)}
+            venv_home = scripts_dir = None
+            if children.get('.venv'):
+                venv_home = Shellmatic.PathValue(project_dir + '/.venv').path
+                scripts_dir = Shellmatic.PathValue(venv_home + '/scripts').path
+            has_config = children.get(self.config_filename) is False
+            return (mtime, Shellmatic.PathValue(project_dir).path, venv_home, scripts_dir, has_config)
+
+        def Update(self):
+            '''
+            Updates the index from the file system, saving it if changed.
+            '''
+            try:
+                mtime = os.stat(self.projects_dir).st_mtime
+            except OSError:
+                mtime = None
+
+            changed = mtime != self._mtime
+            if mtime is None:
+                entries = []
+            elif changed:
+                entries = [
+                    (i_name, i_mtime)
+                    for (i_name, i_is_dir, i_mtime) in _ScanDir(self.projects_dir)
+                    if i_is_dir
+                ]
+            else:
+                entries = []
+                for i_name in self._projects:
+                    try:
+                        entries.append(
+                            (i_name, os.stat(os.path.join(self.projects_dir, i_name)).st_mtime)
+                        )
+                    except OSError:
+                        changed = True
+
+            projects = {}
+            for i_name, i_mtime in entries:
+                project = self._projects.get(i_name)
+                if project is None or project[0] != i_mtime:
+                    project = self._ScanProject(i_name, i_mtime)
+                    changed = True
+                projects[i_name] = project
+
+            if changed:
+                self._mtime = mtime
+                self._projects = projects
+                self._keys = sorted(
+                    (ntpath.normcase(i_name), i_name)
+                    for (i_name, i_project) in six.iteritems(projects)
+                    if i_project[2] is not None
+                )
+                self._Save()
 
+        def GetProject(self, name):
+            '''
+            :return tuple(unicode, unicode, unicode, bool)|None:
+                The project directory, virtualenv home, scripts directory and if it has a
+                configuration file. None if the project is not found.
+            '''
+            project = self._projects.get(name)
+            if project is None:
+                return None
+            return project[1:]
 
-    def SaveJson(self, filename, flags=()):
+        def Complete(self, prefix=''):
+            '''
+            :param unicode prefix:
+            :return list(unicode):
+                The names of the projects with a virtualenv starting with the prefix (case
+                insensitive), sorted.
+            '''
+            import bisect
+
+            prefix = ntpath.normcase(prefix)
+            index = bisect.bisect_left(self._keys, (prefix,))
+            result = []
+            for i_key, i_name in self._keys[index:]:
+                if not i_key.startswith(prefix):
+                    break
+                result.append(i_name)
+            return result
+
+
+    class ExecutableIndex(object):
         '''
-        Saves the configuration in a JSON file.
+        A persistent index of the executables found in the directories of a path-list (PATH): finds
+        the executables shadowed by others with the same name and materializes the ones a shell
+        would run in a single shim directory.
 
-        :param unicode filename:
+        A directory is only listed again when its modification time changes.
         '''
-        import json
 
-        environment = {
-            i : v.value.AsJson()
-            for (i,v) in
-            six.iteritems(self.environment)
-        }
-        data = {
-            'environment' : environment,
-        }
-        contents = json.dumps(
-            data,
-            sort_keys=True,
-            indent=4,
-            separators=(',', ': '),
-            ensure_ascii=False
-        )
-        CreateFile(filename, contents, encoding='UTF-8')
+        VERSION = 1
 
+        def __init__(self, filename, paths, pathext=None):
+            '''
+            Loads the index, updating it (see Update).
+
+            :param unicode filename:
+                The index file.
+            :param list(unicode) paths:
+                The directories, in lookup order.
+            :param list(unicode) pathext:
+                The executables extensions, as in PATHEXT. Defaults to PATHEXT on Windows. If empty,
+                the executables are the files with execute permission (POSIX).
+            '''
+            import sys
 
-    def Workon(self, console_, name):
-        """
-        Activate a project's virtualenv.
+            if pathext is None and sys.platform == 'win32':
+                pathext = os.environ.get('PATHEXT', '.COM;.EXE;.BAT;.CMD').split(ntpath.pathsep)
 
-        The virtual environment must be placed on $PROJECTS_DIR/<name>/.venv
+            self.filename = filename
+            self.paths = []
+            for i_path in paths:
+                if i_path and i_path not in self.paths:
+                    self.paths.append(i_path)
+            self.pathext = tuple(i.lower() for i in pathext or ())
 
-        :param name: The project name.
-        """
-        # Obtain the new project and venv directories
-        new_project_dir = self.PathValue('$PROJECTS_DIR/%(name)s' % locals())
-        new_venv_home = self.PathValue('%(new_project_dir)s/.venv' % locals())
-        new_scripts_dir = self.PathValue('%(new_venv_home)s/scripts' % locals())
+            # {directory : (mtime, {command : filename})}
+            self._directories = {}
 
-        # Check if the new virtualenv really exists
-        if not new_venv_home.IsDir():
-            console_.Print('{}: Unable to find virtualenv.'.format(new_venv_home.path))
-            return
+            self._Load()
+            self.Update()
 
-        # Unload previous virtualenv (if any)
-        old_name = os.environ.get('VIRTUALENV')
-        if old_name and not old_name.startswith('('):
-            old_venv_home = self.PathValue('$PROJECTS_DIR/%(old_name)s/.venv' % locals())
-            old_scripts_dir = self.PathValue('%(old_venv_home)s/scripts' % locals())
-
-            path = self.PathListValue(os.environ['PATH'])
-            path.Remove(old_scripts_dir)
-            self.EnvironmentSet('_environ:PATH', path)
-
-        # Load new virtualenv
-        self.EnvironmentSet(name + ':venv:PATH', new_scripts_dir.path)
-        self.EnvironmentSet(name + ':venv:VIRTUALENV', name)
-        self.EnvironmentSet(name + ':venv:PYTHONHOME', new_venv_home.path)
-        console_.Print('%s: Activating virtualenv.' % new_venv_home.path)
-
-        # Load environment configuration
-        new_config_filename = new_project_dir.path + '/' + self.ENVIRONMENT_FILENAME
-        if os.path.isfile(new_config_filename):
-            self.LoadJson(new_config_filename, flags=(name,))
-            console_.Print('%s: Loading configuration.' % new_config_filename)
+        def _Load(self):
+            data = Shellmatic._LoadMarshal(self.filename, self.VERSION)
+            if data is not None and data[0] == self.pathext:
+                self._directories = data[1]
+
+        def _Save(self):
+            Shellmatic._SaveMarshal(self.filename, self.VERSION, (self.pathext, self._directories))
+
+        def _ScanDirectory(self, directory):
+            '''
+            :return dict(unicode, unicode):
+                The executables filenames by command name. With PATHEXT the command is the
+                lowercase name without extension, preferring the first extension in PATHEXT.
+            '''
+            result = {}
+            for i_name, i_is_dir, _mtime in _ScanDir(directory):
+                if i_is_dir:
+                    continue
+                if self.pathext:
+                    command, ext = os.path.splitext(i_name.lower())
+                    if ext not in self.pathext:
+                        continue
+                    current = result.get(command)
+                    if current is not None:
+                        current_ext = os.path.splitext(current.lower())[1]
+                        if self.pathext.index(current_ext) < self.pathext.index(ext):
+                            continue
+                    result[command] = i_name
+                elif os.access(os.path.join(directory, i_name), os.X_OK):
+                    result[i_name] = i_name
+            return result
+
+        def Update(self):
+            '''
+            Updates the index from the file system, saving it if changed.
+            '''
+            directories = {}
+            for i_path in self.paths:
+                try:
+                    mtime = os.stat(i_path).st_mtime
+                except OSError:
+                    mtime = None
+                entry = self._directories.get(i_path)
+                if entry is None or entry[0] != mtime:
+                    entry = (mtime, {} if mtime is None else self._ScanDirectory(i_path))
+                directories[i_path] = entry
+
+            if directories != self._directories:
+                self._directories = directories
+                self._Save()
+
+        def GetExecutables(self, command):
+            '''
+            :param unicode command:
+            :return list(unicode):
+                The executables for the command, in lookup order: the first one runs, shadowing the
+                others.
+            '''
+            if self.pathext:
+                command = command.lower()
+            result = []
+            for i_path in self.paths:
+                filename = self._directories[i_path][1].get(command)
+                if filename is not None:
+                    result.append(os.path.join(i_path, filename))
+            return result
+
+        def Which(self, command):
+            '''
+            :return unicode|None:
+                The executable running for the command.
+            '''
+            result = self.GetExecutables(command)
+            return result[0] if result else None
+
+        def GetCommands(self):
+            '''
+            :return dict(unicode, list(unicode)):
+                Maps every command to its executables (see GetExecutables).
+            '''
+            result = {}
+            for i_path in self.paths:
+                for j_command, j_filename in six.iteritems(self._directories[i_path][1]):
+                    result.setdefault(j_command, []).append(os.path.join(i_path, j_filename))
+            return result
+
+        def GetShadowed(self):
+            '''
+            :return list(tuple(unicode, list(unicode))):
+                The commands with more than one executable and their executables, sorted by command.
+            '''
+            return sorted(
+                (i_command, i_executables)
+                for (i_command, i_executables) in six.iteritems(self.GetCommands())
+                if len(i_executables) > 1
+            )
+
+        def CreateShims(self, shims_dir):
+            '''
+            Creates a launcher for the executable of every command in the shims directory, so that
+            with the directory alone in the path-list the commands resolve with a single lookup.
+            Shims no longer matching an executable are removed.
+
+            Shims are launchers, never links: executables find their runtime from the path they
+            are started from (eg.: a virtualenv python finds its pyvenv.cfg next to it). On POSIX
+            they are shell scripts executing the executable. On Windows only BATCH files have
+            shims, since a BATCH launcher changes how other executables behave (Ctrl+C prompt,
+            calls without "call"): they are found in their own directories.
+
+            :param unicode shims_dir:
+                Must not be one of the indexed directories.
+            :return int:
+                The number of shims created or updated.
+            '''
+            if not os.path.isdir(shims_dir):
+                os.makedirs(shims_dir)
+
+            # {shim name : launcher contents}
+            shims = {}
+            for i_command, i_executables in six.iteritems(self.GetCommands()):
+                executable = i_executables[0]
+                if not self.pathext:
+                    quoted = "'%s'" % executable.replace("'", "'\\''")
+                    shims[i_command] = '#!/bin/sh\nexec %s "$@"\n' % quoted
+                    continue
+                ext = os.path.splitext(executable)[1].lower()
+                if ext in self.BATCH_EXTENSIONS:
+                    shims[i_command + ext] = '@"%s" %%*' % executable
+
+            for i_name in os.listdir(shims_dir):
+                if i_name not in shims:
+                    os.remove(os.path.join(shims_dir, i_name))
+
+            result = 0
+            for i_name, i_launcher in six.iteritems(shims):
+                shim = os.path.join(shims_dir, i_name)
+                if os.path.islink(shim):
+                    # Created by older versions, that linked the executables.
+                    os.remove(shim)
+                elif os.path.isfile(shim) and GetFileContents(shim) == i_launcher:
+                    continue
+                CreateFile(shim, i_launcher)
+                if not self.pathext:
+                    os.chmod(shim, 0o755)
+                result += 1
+            return result
+
+        # The executables extensions run by cmd.exe: the only ones with shims, BATCH launchers.
+        BATCH_EXTENSIONS = ('.bat', '.cmd')
+
+
+    class Assignment(object):
+        '''
+        A shell independent environment variable assignment: the intermediate form generated once
+        (see GetAssignments) and rendered for each shell by an Emitter.
+        '''
+
+        __slots__ = ('name', 'append', 'typename', 'nodep', 'values')
+
+        def __init__(self, name, append, typename, nodep, values):
+            '''
+            :param unicode name:
+            :param bool append:
+                If True the values are appended to the variable.
+            :param unicode typename:
+                The value TYPENAME: text, path or pathlist.
+            :param bool nodep:
+                If True the values are literal, without references.
+            :param list(unicode) values:
+                The value texts, with references as $name: one for each path of a pathlist.
+            '''
+            self.name = name
+            self.append = append
+            self.typename = typename
+            self.nodep = nodep
+            self.values = values
+
+        def __repr__(self):
+            return '<Assignment %s%s%s>' % (
+                self.name,
+                '+=' if self.append else '=',
+                ntpath.pathsep.join(self.values)
+            )
+
+        def GetReferences(self):
+            '''
+            :return set(unicode):
+                The names (upper case) of the variables referenced by the values.
+            '''
+            if self.nodep:
+                return set()
+            result = set()
+            for i_value in self.values:
+                tokens = Shellmatic.ValueType._Tokenize(i_value)
+                result.update(i.upper() for i in Shellmatic.ValueType._GetNames(tokens))
+            return result
+
+
+    class Emitter(object):
+        '''
+        Renders assignments (see GetAssignments) as a script for a shell, in a single pass.
+
+        Subclasses define the shell syntax: how to quote literals, reference variables and assign.
+        '''
+
+        # Separates the paths of a pathlist, and the appended values.
+        PATHSEP = ntpath.pathsep
+
+        # The platform of the shell, matching the aliases platform flags (see AsAliases).
+        PLATFORM = 'windows'
+
+        # If set, the aliases are written to a macros file, this being the line loading it.
+        MACROS_LOADER = None
+
+        def Render(self, assignments):
+            '''
+            :param list(Assignment) assignments:
+            :return unicode:
+            '''
+            return '\n'.join([self.Assign(i, self.RenderValues(i)) for i in assignments])
+
+        def RenderValues(self, assignment):
+            '''
+            :param Assignment assignment:
+            :return list(unicode):
+                The values in the shell syntax, paths normalized (see NormalizePath).
+            '''
+            result = []
+            for i_value in assignment.values:
+                if assignment.typename != Shellmatic.TextValue.TYPENAME:
+                    i_value = self.NormalizePath(i_value, assignment.nodep)
+                if assignment.nodep:
+                    result.append(self.Literal(i_value))
+                    continue
+                tokens = list(Shellmatic.ValueType._Tokenize(i_value))
+                tokens[1::2] = Shellmatic.ValueType._GetNames(tokens)
+                result.append(''.join([
+                    self.Reference(j_token.upper()) if j_index % 2 else self.Literal(j_token)
+                    for (j_index, j_token) in enumerate(tokens)
+                    if j_token or j_index % 2
+                ]))
+            return result
+
+        def NormalizePath(self, path, nodep):
+            return ntpath.normpath(path) if nodep else ntpath.normcase(ntpath.normpath(path))
+
+        def Literal(self, text):
+            raise NotImplementedError()
+
+        def Reference(self, name):
+            raise NotImplementedError()
+
+        def Assign(self, assignment, values):
+            '''
+            :param Assignment assignment:
+            :param list(unicode) values:
+                The rendered values.
+            :return unicode:
+                The script line.
+            '''
+            raise NotImplementedError()
+
+        def RenderAliases(self, assignments):
+            '''
+            :param list(Assignment) assignments:
+                The aliases, as assignments of their command line (text) or executable (path).
+            :return unicode:
+            '''
+            return '\n'.join([
+                self.Alias(i, self.PATHSEP.join(self.RenderValues(i)))
+                for i in assignments
+            ])
+
+        def Alias(self, assignment, value):
+            '''
+            :param Assignment assignment:
+            :param unicode value:
+                The rendered value.
+            :return unicode:
+                The alias definition line.
+            '''
+            raise NotImplementedError()
+
+
+    class CmdEmitter(Emitter):
+        '''
+        cmd.exe: the same script as AsBatch.
+        '''
+
+        def Literal(self, text):
+            return text
+
+        def Reference(self, name):
+            return '%' + name + '%'
+
+        def Assign(self, assignment, values):
+            name = assignment.name
+            value = self.PATHSEP.join(values)
+            if assignment.append:
+                return 'set %(name)s=%%%(name)s%%;%(value)s' % locals()
+            return 'set %(name)s=%(value)s' % locals()
+
+        # All the aliases are loaded by a single doskey process.
+        MACROS_LOADER = 'doskey /macrofile="%s"'
+
+        def Alias(self, assignment, value):
+            name = assignment.name
+            # "$" introduces doskey parameters ($*).
+            value = value.replace('$', '$$')
+            if assignment.typename == Shellmatic.PathValue.TYPENAME:
+                value = '"%s"' % value
+            return '%(name)s=%(value)s $*' % locals()
+
+
+    class PowerShellEmitter(Emitter):
+
+        def Literal(self, text):
+            return text.replace('`', '``').replace('"', '`"').replace('$', '`$')
+
+        def Reference(self, name):
+            return '${env:%s}' % name
+
+        def Assign(self, assignment, values):
+            name = assignment.name
+            value = self.PATHSEP.join(values)
+            if assignment.append:
+                value = self.Reference(name) + self.PATHSEP + value
+            elif not value:
+                return 'Remove-Item Env:%(name)s -ErrorAction SilentlyContinue' % locals()
+            return '${env:%(name)s} = "%(value)s"' % locals()
+
+        def Alias(self, assignment, value):
+            name = assignment.name
+            if assignment.typename == Shellmatic.PathValue.TYPENAME:
+                value = '& "%s"' % value
+            # Built-in aliases (eg.: cp) take precedence over functions.
+            return (
+                'Remove-Item Alias:%(name)s -Force -ErrorAction SilentlyContinue; '
+                'function global:%(name)s { %(value)s @args }'
+            ) % locals()
+
+
+    class BashEmitter(Emitter):
+        '''
+        bash and zsh.
+        '''
+
+        PATHSEP = ':'
+
+        PLATFORM = 'posix'
+
+        NAME_RE = re.compile(r'^[A-Za-z_]\w*$')
+        ALIAS_RE = re.compile(r'^[^\s/$`=\'"\\]+$')
+
+        def NormalizePath(self, path, nodep):
+            import posixpath
+            return posixpath.normpath(path)
+
+        def Literal(self, text):
+            return re.sub(r'([\\"$`])', r'\\\1', text)
+
+        def Reference(self, name):
+            return '${%s}' % name
+
+        def Assign(self, assignment, values):
+            name = assignment.name
+            if not self.NAME_RE.match(name):
+                return '# %(name)s: invalid variable name' % locals()
+            value = self.PATHSEP.join(values)
+            if assignment.append:
+                # Without a leading separator if the variable is not set.
+                value = '${%(name)s:+${%(name)s}%(sep)s}' % dict(name=name, sep=self.PATHSEP) + value
+            elif not value:
+                return 'unset %(name)s' % locals()
+            return 'export %(name)s="%(value)s"' % locals()
+
+        def Alias(self, assignment, value):
+            name = assignment.name
+            if not self.ALIAS_RE.match(name):
+                return '# %(name)s: invalid alias name' % locals()
+            if assignment.typename == Shellmatic.PathValue.TYPENAME:
+                value = '\\"%s\\"' % value
+            return 'alias %(name)s="%(value)s"' % locals()
+
+
+    class FishEmitter(BashEmitter):
+        '''
+        fish: path lists are lists variables.
+        '''
+
+        def Literal(self, text):
+            return '"' + re.sub(r'([\\"$])', r'\\\1', text) + '"' if text else ''
+
+        def Reference(self, name):
+            return '"$%s"' % name
+
+        def Assign(self, assignment, values):
+            name = assignment.name
+            if not self.NAME_RE.match(name):
+                return '# %(name)s: invalid variable name' % locals()
+            values = [i or '""' for i in values]
+            if assignment.typename == Shellmatic.PathListValue.TYPENAME:
+                if assignment.append:
+                    values.insert(0, '$' + name)
+            else:
+                values = [''.join(values)]
+                if assignment.append:
+                    values = ['"$%(name)s%(sep)s"' % dict(name=name, sep=self.PATHSEP) + values[0]]
+            if values == ['""'] and not assignment.append:
+                return 'set -e %(name)s' % locals()
+            return 'set -gx %s %s' % (name, ' '.join(values))
+
+        def Alias(self, assignment, value):
+            name = assignment.name
+            if not self.ALIAS_RE.match(name):
+                return '# %(name)s: invalid alias name' % locals()
+            if assignment.typename == Shellmatic.PathValue.TYPENAME:
+                value = '"\'"%s"\'"' % value
+            return 'alias %s %s' % (name, value or '""')
+
+
+    # The emitters by shell name (see AsScript).
+    EMITTERS = {
+        'cmd' : CmdEmitter,
+        'powershell' : PowerShellEmitter,
+        'bash' : BashEmitter,
+        'zsh' : BashEmitter,
+        'fish' : FishEmitter,
+    }
+
+
+    SECTION_ENVIRONMENT = 'environment'
+    SECTION_ALIASES = 'aliases'
+    SECTION_CALLS = 'calls'
+    SECTION_SETUP = 'setup'
+    ENVIRONMENT_FILENAME = '.shellmatic.json'
+
+    def __init__(self):
+        self.environment = odict()
+        self.alias = odict()
+        self.calls = odict()
+
+        # AsBatch state, maintained incrementally by _Define.
+        # - The environment keys for each variable name, in definition order.
+        self._groups = {}
+        # - Variables names defined since the last AsBatch, to update their dependencies.
+        self._changed = set()
+        # - The (union of the) dependencies of each variable name.
+        self._dependencies = {}
+        # - The names of the variables depending on each name (the inverse of _dependencies).
+        self._dependents = {}
+        # - The variables names sorted by dependency, None if never sorted, and their sort keys:
+        #   [(sweep, name)] (see DependencyGraph.TopologicalSort) and {name : sweep}.
+        self._order = None
+        self._order_keys = []
+        self._sweeps = {}
+        # - The assignments of each variable name: {name : {(append, platform) : [Assignment]}}
+        self._assignments = {}
+
+        # Incremented on every change, invalidating the Resolve results.
+        self._version = 0
+        self._resolved = None
+
+        # The layers stack (see PushLayer): [(name, {(table, key) : previous value or None})], the
+        # table being the attribute with the value: environment, alias or calls.
+        self._layers = []
+
+
+    def LoadEnvironment(self, environ=None):
+        '''
+        Loads environment from the current environment.
+
+        The variables are created lazily: their types and values are only resolved when used.
+
+        :param dict|None environ:
+            An alternative to os.environ. Used for testing purposes.
+        '''
+        if environ is None:
+            environ = os.environ
+        for i_name, i_value in six.iteritems(environ):
+            name = '_environ:' + self._Decode(i_name)
+            self._Define(name, self.EnvVar(name, self._Decode(i_value), lazy=True))
+
+
+    @classmethod
+    def _Decode(cls, text, encoding='ascii'):
+        '''
+        :param bytes|unicode text:
+        :return unicode:
+        '''
+        if isinstance(text, six.text_type):
+            return text
+        return text.decode(encoding)
+
+
+    class Environ(dict):
+        '''
+        A process environment, following the conventions of its platform: on Windows the variables
+        names are case insensitive (stored upper case), path-lists are separated by ";" and paths
+        compared ignoring case.
+        '''
+
+        def __init__(self, environ=(), platform=None):
+            '''
+            :param dict environ:
+            :param unicode platform:
+                "windows" or "posix". Defaults to the environ platform, if an Environ, otherwise to
+                the current platform.
+            '''
+            import posixpath
+
+            dict.__init__(self)
+            if platform is None:
+                platform = getattr(environ, 'platform', None)
+            if platform is None:
+                platform = 'windows' if os.name == 'nt' else 'posix'
+            self.platform = platform
+            self._path = ntpath if platform == 'windows' else posixpath
+            self.pathsep = self._path.pathsep
+            for i_name, i_value in six.iteritems(dict(environ)):
+                self[Shellmatic._Decode(i_name)] = Shellmatic._Decode(i_value)
+
+        def _Key(self, name):
+            return name.upper() if self._path is ntpath else name
+
+        def __getitem__(self, name):
+            return dict.__getitem__(self, self._Key(name))
+
+        def __setitem__(self, name, value):
+            dict.__setitem__(self, self._Key(name), value)
+
+        def __contains__(self, name):
+            return dict.__contains__(self, self._Key(name))
+
+        def get(self, name, default=None):
+            return dict.get(self, self._Key(name), default)
+
+        def FormatPath(self, path):
+            '''
+            :param unicode path:
+            :return unicode:
+                The path as written in this platform.
+            '''
+            return self._path.normpath(path) if path else path
+
+        def GetPathKey(self, path):
+            '''
+            :param unicode path:
+            :return unicode:
+                The path comparison key in this platform.
+            '''
+            return self._path.normcase(self._path.normpath(path))
+
+        def GetPathKeys(self, pathlist):
+            '''
+            :param unicode pathlist:
+            :return list(unicode):
+                The comparison keys of the path-list paths.
+            '''
+            return [self.GetPathKey(i) for i in pathlist.split(self.pathsep) if i]
+
+        def IsSame(self, value, other, typename):
+            '''
+            :param unicode value:
+            :param unicode other:
+            :param unicode typename:
+                The values type (see ValueType.TYPENAME).
+            :return bool:
+                If the values are the same for the type.
+            '''
+            if typename == Shellmatic.TextValue.TYPENAME:
+                return value == other
+            if typename == Shellmatic.PathValue.TYPENAME:
+                return self.GetPathKey(value) == self.GetPathKey(other)
+            return self.GetPathKeys(value) == self.GetPathKeys(other)
+
+
+    class BatchEnviron(Environ):
+        '''
+        The environment of a BATCH script (cmd.exe).
+        '''
+
+        def __init__(self, environ=()):
+            Shellmatic.Environ.__init__(self, environ, platform='windows')
+
+
+    def EnvironmentSet(self, name, value):
+        self._Define(name, self.EnvVar(name, value))
+
+
+    def _Define(self, key, envvar):
+        '''
+        Sets an environment variable, discarding only the AsBatch state affected by it.
+
+        :param unicode key:
+            The variable name with flags.
+        :param EnvVar envvar:
+        '''
+        name = envvar.name
+        previous = self.environment.get(key)
+        self._Record('environment', key, previous)
+        if previous is None:
+            self._groups.setdefault(name, []).append(key)
+        self.environment[key] = envvar
+        self._Changed(name)
+
+
+    def _Record(self, table, key, previous):
+        '''
+        Records a change in the top layer, if any, to undo it (see PopLayer).
+
+        :param unicode table:
+            The changed attribute: environment, alias or calls.
+        :param unicode key:
+        :param object previous:
+            The value replaced, None if none.
+        '''
+        if self._layers:
+            # Copy-on-write: the layer keeps the value it replaced (only the first).
+            self._layers[-1][1].setdefault((table, key), previous)
+
+
+    def _Undefine(self, key, previous):
+        '''
+        Restores an environment variable to its previous value, removing it if it had none.
+
+        :param unicode key:
+        :param EnvVar|None previous:
+        '''
+        name = self.environment[key].name
+        if previous is None:
+            del self.environment[key]
+            group = self._groups[name]
+            group.remove(key)
+            if not group:
+                del self._groups[name]
+        else:
+            self.environment[key] = previous
+        self._Changed(name)
+
+
+    def _Changed(self, name):
+        '''
+        Discards the AsBatch state affected by a change in the variable.
+
+        :param unicode name:
+        '''
+        self._changed.add(name)
+        self._assignments.pop(name, None)
+        self._version += 1
+
+
+    def PushLayer(self, name):
+        '''
+        Starts a new environment layer: the following changes are undone by popping it (see
+        PopLayer). Eg.: a base layer with reset.json, the user configuration and a project on top.
+
+        Layers are copy-on-write: they only store the values they replace, so pushing and popping
+        them costs only the variables (and aliases and calls) they change.
+
+        :param unicode name:
+        '''
+        self._layers.append((name, {}))
+
+
+    def PopLayer(self):
+        '''
+        Removes the top environment layer, undoing its changes.
+
+        :return unicode:
+            The layer name.
+        '''
+        name, changes = self._layers.pop()
+        for (i_table, i_key), i_previous in six.iteritems(changes):
+            if i_table == 'environment':
+                self._Undefine(i_key, i_previous)
+            elif i_previous is None:
+                del getattr(self, i_table)[i_key]
+            else:
+                getattr(self, i_table)[i_key] = i_previous
+        return name
+
+
+    @property
+    def layers(self):
+        '''
+        :return list(unicode):
+            The names of the environment layers, from the bottom.
+        '''
+        return [i for (i, _changes) in self._layers]
+
+
+    def Snapshot(self):
+        '''
+        Takes a snapshot of the environment, to return to with Rollback. It is an anonymous layer
+        (named None).
+
+        :return int:
+        '''
+        self.PushLayer(None)
+        return len(self._layers)
+
+
+    def Rollback(self, snapshot):
+        '''
+        Returns the environment to a snapshot, popping the layers pushed after it and undoing the
+        changes since.
+
+        :param int snapshot:
+            See Snapshot.
+        '''
+        while len(self._layers) >= snapshot:
+            self.PopLayer()
+
+
+    def AsBatch(self, console_, append=False, environ=None, roots=None, coalesce=False):
+        '''
+        Generates the BATCH script (cmd.exe) setting the environment: AsScript for cmd.
+
+        The dependencies and order of the variables are kept between calls: after changing a
+        variable only its own dependencies are obtained again, and the variables sorted again only
+        if they changed.
+
+        :param clikit.Console console_:
+        :param dict environ:
+            If given, generates only the lines changing this environment (usually os.environ): see
+            EnvVar.GetDelta.
+        :param list(unicode) roots:
+            If given, generates only the variables reachable from these (see GetReachable).
+        :param bool coalesce:
+            If True merges the lines of each variable into a single line, when possible (see
+            _CoalesceAssignments).
+        :return unicode:
+        '''
+        return self.AsScript('cmd', append, environ, roots, coalesce)
+
+
+    def _GetDeltas(self, name, environ, append):
+        '''
+        Returns the definitions of a variable changing the environment (see EnvVar.GetDelta).
+
+        :param unicode name:
+        :param Environ environ:
+            Updated with the results.
+        :param bool append:
+            See AsBatch.
+        :return list(tuple(EnvVar, ValueType, bool)):
+            The variables, the values to set and if appending.
+        '''
+        envvars = [self.environment[i] for i in self._groups[name]]
+        result = []
+        original = environ.get(name)
+        for i_index, i_envvar in enumerate(envvars):
+            i_append = self._IsAppend(i_envvar, i_index, append)
+            value = i_envvar.GetDelta(environ, append=i_append)
+            if value is not None:
+                result.append((i_envvar, value, i_append))
+        if result and original is not None:
+            # The definitions for a variable may, as a whole, leave it unchanged.
+            if environ.IsSame(environ[name], original, envvars[-1].value.TYPENAME):
+                environ[name] = original
+                return []
+        return result
+
+
+    def GetAssignments(self, append=False, environ=None, roots=None, coalesce=False, platform=None):
+        '''
+        Returns the environment, resolved and ordered, as shell independent assignments: rendered
+        for each shell by an Emitter (see AsScript).
+
+        :param bool append:
+        :param dict environ:
+        :param list(unicode) roots:
+        :param bool coalesce:
+            See AsBatch.
+        :param unicode platform:
+            The platform of the shells executing the assignments (see Environ), comparing and
+            appending to the given environ values with its conventions. Defaults to the environ
+            platform.
+        :return list(Assignment):
+        '''
+        if environ is not None:
+            environ = self.Environ(environ, platform=platform)
+
+        order = self._GetOrder()
+        if roots is not None:
+            reachable = self.GetReachable(roots)
+            order = [i for i in order if i in reachable]
+
+        result = []
+        for i_name in order:
+            assignments = self._GetVariableAssignments(i_name, append, platform)
+            if environ is not None:
+                # The definitions changing the environ, reusing their assignments if unchanged.
+                envvars = [self.environment[j] for j in self._groups[i_name]]
+                cached = {id(j_envvar) : j for (j_envvar, j) in zip(envvars, assignments)}
+                assignments = []
+                for j_envvar, j_value, j_append in self._GetDeltas(i_name, environ, append):
+                    assignment = cached[id(j_envvar)]
+                    if j_value is not j_envvar.value or j_append != assignment.append:
+                        assignment = self._CreateAssignment(j_envvar, j_value, j_append)
+                    assignments.append(assignment)
+            if coalesce:
+                assignments = self._CoalesceAssignments(i_name, assignments)
+            result += assignments
+        return result
+
+
+    def _GetVariableAssignments(self, name, append, platform):
+        '''
+        Returns the assignments of all the definitions of a variable, kept until it changes (see
+        _Changed).
+
+        :param unicode name:
+        :param bool append:
+        :param unicode platform:
+            See GetAssignments.
+        :return list(Assignment):
+        '''
+        cache = self._assignments.setdefault(name, {})
+        result = cache.get((append, platform))
+        if result is None:
+            envvars = [self.environment[i] for i in self._groups[name]]
+            result = [
+                self._CreateAssignment(j_envvar, j_envvar.value, self._IsAppend(j_envvar, j, append))
+                for (j, j_envvar) in enumerate(envvars)
+            ]
+            cache[(append, platform)] = result
+        return result
+
+
+    def _CreateAssignment(self, envvar, value, append):
+        '''
+        :param EnvVar envvar:
+        :param ValueType value:
+            The envvar value or, changing an environment, the part of it to set.
+        :param bool append:
+        :return Assignment:
+        '''
+        if isinstance(value, self.PathListValue):
+            values = [i.AsPrint() for i in value]
+        else:
+            values = [value.AsPrint()]
+        return self.Assignment(
+            envvar.name,
+            append,
+            value.TYPENAME,
+            envvar.HasFlag(self.EnvVar.FLAG_NODEP),
+            values,
+        )
+
+
+    @classmethod
+    def _CoalesceAssignments(cls, name, assignments):
+        '''
+        Merges the assignments of a variable into one with the same result:
+
+            set PATH=a
+            set PATH=%PATH%;b    ->    set PATH=a;b
+
+        Only possible if the assignments reference the variable solely to append to it, otherwise
+        its intermediate values are needed.
+
+        :param unicode name:
+        :param list(Assignment) assignments:
+        :return list(Assignment):
+        '''
+        if len(assignments) < 2:
+            return assignments
+        first = assignments[0]
+        for i_assignment in assignments:
+            if i_assignment.nodep or name.upper() in i_assignment.GetReferences():
+                return assignments
+            if i_assignment.typename != first.typename:
+                return assignments
+            if i_assignment is not first and not i_assignment.append:
+                return assignments
+        values = []
+        for i_assignment in assignments:
+            values += i_assignment.values
+        return [cls.Assignment(name, first.append, first.typename, False, values)]
+
+
+    def AsScript(self, shell, append=False, environ=None, roots=None, coalesce=False):
+        '''
+        As AsBatch, for the given shell (see EMITTERS).
+
+        :param unicode shell:
+        :return unicode:
+        '''
+        return self.AsScripts([shell], append, environ, roots, coalesce)[shell]
+
+
+    def AsScripts(self, shells, append=False, environ=None, roots=None, coalesce=False):
+        '''
+        As AsBatch, for each of the given shells (see EMITTERS). The environment is resolved once
+        for all of them or, if changing an environ, once for each of their platforms.
+
+        :param list(unicode) shells:
+        :return dict(unicode, unicode):
+            The script for each shell.
+        '''
+        assignments = {}
+        result = {}
+        for i_shell in shells:
+            emitter = self.EMITTERS[i_shell]()
+            platform = None if environ is None else emitter.PLATFORM
+            if platform not in assignments:
+                assignments[platform] = self.GetAssignments(
+                    append, environ, roots, coalesce, platform=platform
+                )
+            result[i_shell] = emitter.Render(assignments[platform])
+        return result
+
+
+    def _GetOrder(self):
+        '''
+        Returns the variables names sorted by dependency, updating the dependencies of the variables
+        changed since the last call.
+
+        The order is the same of DependencyGraph.TopologicalSort, maintained incrementally: only the
+        changed variables and their dependents (even indirect) are placed again.
+
+        :return list(unicode):
+        '''
+        import bisect
+        from collections import deque
+
+        seeds = set()
+        for i_name in self._changed:
+            old = self._dependencies.get(i_name)
+            if i_name in self._groups:
+                new = set()
+                for j_key in self._groups[i_name]:
+                    new.update(self.environment[j_key].GetDependencies())
+                if new == old:
+                    continue
+                self._dependencies[i_name] = new
+            elif old is None:
+                continue
+            else:
+                # Removed by PopLayer.
+                del self._dependencies[i_name]
+                new = set()
+            for j_name in (old or set()).difference(new):
+                self._dependents[j_name].discard(i_name)
+            for j_name in new.difference(old or ()):
+                self._dependents.setdefault(j_name, set()).add(i_name)
+            seeds.add(i_name)
+            if old is None or i_name not in self._dependencies:
+                # Added or removed: a dependency of its dependents.
+                seeds.update(self._dependents.get(i_name, ()))
+        self._changed.clear()
+
+        if self._order is None:
+            self._sweeps = {}
+            self._order_keys = []
+            seeds = set(self._dependencies)
+        elif not seeds:
+            return self._order
+
+        affected = set()
+        pending = list(seeds)
+        while pending:
+            name = pending.pop()
+            if name not in affected:
+                affected.add(name)
+                pending.extend(self._dependents.get(name, ()))
+
+        # The sweeps (see TopologicalSort) of the affected variables, in dependency order: the
+        # others are unchanged.
+        defined = affected.intersection(self._dependencies)
+        dependencies = {
+            i : {j for j in self._dependencies[i] if j != i and j in self._dependencies}
+            for i in defined
+        }
+        counts = {i : len(dependencies[i].intersection(defined)) for i in defined}
+        queue = deque(sorted(i for i in defined if not counts[i]))
+        sweeps = self._sweeps
+        visited = 0
+        while queue:
+            name = queue.popleft()
+            visited += 1
+            sweeps[name] = max(
+                [sweeps[j] + (1 if j > name else 0) for j in dependencies[name]] or [0]
+            )
+            for j_name in self._dependents.get(name, ()):
+                if j_name != name and j_name in defined:
+                    counts[j_name] -= 1
+                    if not counts[j_name]:
+                        queue.append(j_name)
+        if visited < len(defined):
+            self._order = None
+            # Raises CyclicDependencyError, reporting all the cycles.
+            self.DependencyGraph(sorted(six.iteritems(self._dependencies))).TopologicalSort()
+
+        for i_name in affected.difference(defined):
+            sweeps.pop(i_name, None)
+        keys = [i for i in self._order_keys if i[1] not in affected]
+        new_keys = sorted((sweeps[i], i) for i in defined)
+        if len(new_keys) < 8:
+            for i_key in new_keys:
+                bisect.insort(keys, i_key)
+        else:
+            # Merging two sorted runs is linear.
+            keys += new_keys
+            keys.sort()
+        self._order_keys = keys
+        self._order = [i for (_sweep, i) in keys]
+        return self._order
+
+
+    def GetReachable(self, roots):
+        '''
+        Returns the variables reachable from the roots: the roots and, recursively, the variables
+        they reference.
+
+        :param list(unicode) roots:
+            Variables names (case insensitive).
+        :return set(unicode):
+            The names of the defined variables reachable from the roots.
+        '''
+        self._GetOrder()
+        names = {i.upper() : i for i in self._groups}
+        result = set()
+        pending = [i.upper() for i in roots]
+        while pending:
+            name = names.get(pending.pop())
+            if name is None or name in result:
+                continue
+            result.add(name)
+            pending.extend(self._dependencies[name])
+        return result
+
+
+    def Analyze(self, roots):
+        '''
+        Finds the variables that could be removed from the configuration.
+
+        :param list(unicode) roots:
+            The variables used, eg.: PATH.
+        :return tuple(list(unicode), list(unicode)):
+            The dead variables, not reachable from the roots (see GetReachable), and the
+            unreferenced variables, neither roots nor referenced by any other variable.
+        '''
+        reachable = self.GetReachable(roots)
+        referenced = set()
+        for i_name, i_dependencies in six.iteritems(self._dependencies):
+            referenced.update(i_dependencies.difference([i_name.upper()]))
+        roots = {i.upper() for i in roots}
+
+        dead = sorted(i for i in self._groups if i not in reachable)
+        unreferenced = sorted(
+            i for i in self._groups if i.upper() not in referenced and i.upper() not in roots
+        )
+        return dead, unreferenced
+
+
+    def Resolve(self, environ=None, append=False):
+        '''
+        Returns the environment resulting from the execution of the generated script (see
+        AsScript), with every variable fully expanded. Unlike the values ExpandVars (and
+        PathValue.path), the references see the variables defined here.
+
+        The result is memoized until a variable is set or the base environment changes.
+
+        :param dict environ:
+            The base environment where the script is executed. Defaults to os.environ. Its platform
+            conventions (see Environ) default to the current platform.
+        :param bool append:
+            See AsBatch.
+        :return Environ:
+            Maps variables names to their values, as a process sees them: paths written for the
+            platform and path-lists separated by its path separator (os.pathsep). Can be used to
+            expand values: value.ExpandVars(shellmatic.Resolve())
+        '''
+        if environ is None:
+            environ = os.environ
+        environ = self.Environ(environ)
+        key = (self._version, append, environ.platform, frozenset(six.iteritems(environ)))
+        if self._resolved is None or self._resolved[0] != key:
+            for i_name in self._GetOrder():
+                for j_index, j_key in enumerate(self._groups[i_name]):
+                    envvar = self.environment[j_key]
+                    envvar.GetDelta(environ, append=self._IsAppend(envvar, j_index, append))
+            self._resolved = (key, environ)
+        return self.Environ(self._resolved[1])
+
+
+    def Run(self, command, environ=None, append=True, cwd=None):
+        '''
+        Runs a command in the resolved environment (see Resolve), without writing and executing the
+        BATCH script.
+
+        :param list(unicode) command:
+        :param dict environ:
+            See Resolve.
+        :param bool append:
+            See AsBatch. By default the path lists are appended to the base environment ones.
+        :param unicode cwd:
+        :return int:
+            The command exit code.
+        '''
+        import subprocess
+
+        env = self._GetProcessEnviron(environ, append)
+        return subprocess.call(list(command), env=env, cwd=cwd)
+
+
+    def _GetProcessEnviron(self, environ, append):
+        '''
+        :return dict:
+            The resolved environment (see Resolve) for a subprocess.
+        '''
+        import sys
+
+        result = dict(self.Resolve(environ, append=append))
+        if six.PY2:
+            encoding = sys.getfilesystemencoding()
+            result = {i.encode(encoding) : v.encode(encoding) for (i, v) in six.iteritems(result)}
+        return result
+
+
+    def _IsAppend(self, envvar, index, append):
+        '''
+        Returns whether the BATCH line of the environment variable appends to its current value.
+
+        :param EnvVar envvar:
+        :param int index:
+            The envvar index among the definitions with the same name: all but the first append.
+        :param bool append:
+            See AsBatch.
+        :return bool:
+            False for path-lists with the variable itself as a path ($PATH): they place the current
+            value.
+        '''
+        if index == 0 and not append:
+            return False
+        if envvar.HasFlag(self.EnvVar.TYPE_PATHLIST):
+            for i_path in envvar.value:
+                # Any reference syntax: $PATH, ${PATH}, %PATH%.
+                tokens = self.ValueType._Tokenize(i_path.AsPrint())
+                if tokens[0::2] != ('', ''):
+                    continue
+                if self.ValueType._GetNames(tokens)[0].upper() == envvar.name.upper():
+                    return False
+            return True
+        return index > 0
+
+
+    def LoadJson(self, filename, flags=(), cache=False):
+        '''
+        Loads the configuration from a JSON file.
+
+        The setup section lists external setup scripts, with their arguments, loaded after the
+        environment section (see LoadSetupScript):
+
+            "setup": {"$VS_DIR/vc/vcvarsall.bat": ["x64"]}
+
+        :param unicode filename:
+        :param bool cache:
+            If True loads the configuration from its compiled cache, (re)compiling it when the file
+            changes. See _LoadCompiled.
+        '''
+        if cache:
+            environment, aliases, calls, setup = self._LoadCompiled(filename)
+            for i_key, i_name, i_value in environment:
+                # Defined with the same key as an uncached load. Compiled names carry their type
+                # and values were validated on compilation.
+                key = ':'.join(sorted(flags) + [i_key])
+                name = ':'.join(sorted(flags) + [i_name])
+                self._Define(key, self.EnvVar(name, i_value, lazy=True))
+        else:
+            try:
+                contents = GetFileContents(filename, encoding='UTF-8')
+                environment, aliases, calls, setup = self._ParseSections(contents)
+                for i_name, i_value in environment:
+                    name = ':'.join(sorted(flags) + [i_name])
+                    self.EnvironmentSet(name, i_value)
+            except Exception as e:
+                raise e
+
+        for i_filename, i_args in setup:
+            # The scripts are found as os.path.expandvars would.
+            i_filename = self.PathValue(i_filename).path
+            self.LoadSetupScript(
+                i_filename,
+                i_args,
+                flags=list(flags) + [self._GetSetupFlag(i_filename)],
+            )
+        for i_name, i_value in aliases:
+            self.AliasSet(':'.join(sorted(flags) + [i_name]), i_value)
+        for i_name, i_value in calls:
+            self.CallSet(':'.join(sorted(flags) + [i_name]), i_value)
+
+
+    def AliasSet(self, name, value):
+        '''
+        Sets an alias (see AsAliases).
+
+        :param unicode name:
+            The alias name, prefixed by flags. Aliases are text (a command line) unless typed as a
+            path (an executable). A platform flag (see PLATFORMS) restricts the alias to the shells
+            of that platform.
+        :param unicode value:
+        '''
+        name = self._GetAliasName(name)
+        self._Record('alias', name, self.alias.get(name))
+        self.alias[name] = self.EnvVar(name, value)
+
+
+    @classmethod
+    def _GetAliasName(cls, name):
+        '''
+        :return unicode:
+            The alias name with its type: text if none given.
+        '''
+        flags, _alias = cls.EnvVar._SplitName(name)
+        if flags.intersection(cls.EnvVar.TYPES):
+            return name
+        return cls.EnvVar.TYPE_TEXT + ':' + name
+
+
+    def CallSet(self, name, command):
+        '''
+        Sets a call: a command executed once, and again only if changed (see RunCalls).
+
+        :param unicode name:
+            The call name, prefixed by flags.
+        :param unicode command:
+            The command line.
+        '''
+        self._Record('calls', name, self.calls.get(name))
+        self.calls[name] = command
+
+
+    # The aliases flags restricting them to the shells of a platform (see Emitter.PLATFORM).
+    PLATFORMS = ('windows', 'posix')
+
+    def AsAliases(self, shell, macros_filename=None):
+        '''
+        Generates the aliases definitions for the given shell (see EMITTERS) in a single block:
+        shell aliases or functions or, for cmd.exe, a doskey macros file loaded by one doskey call.
+
+        :param unicode shell:
+        :param unicode macros_filename:
+            The macros file, (re)written for shells with macros files (see Emitter.MACROS_LOADER).
+            If None the macros are returned instead, with no file written (eg.: testing).
+        :return unicode:
+            The script lines defining the aliases. Empty if none.
+        '''
+        emitter = self.EMITTERS[shell]()
+        aliases = odict()
+        for i_envvar in six.itervalues(self.alias):
+            platforms = i_envvar.flags.intersection(self.PLATFORMS)
+            if platforms and emitter.PLATFORM not in platforms:
+                continue
+            value = i_envvar.value
+            if isinstance(value, self.PathListValue):
+                values = [j.AsPrint() for j in value]
+            else:
+                values = [value.AsPrint()]
+            # Redefined aliases keep their position.
+            aliases[i_envvar.name] = self.Assignment(
+                i_envvar.name,
+                False,
+                value.TYPENAME,
+                i_envvar.HasFlag(self.EnvVar.FLAG_NODEP),
+                values,
+            )
+        if not aliases:
+            return ''
+
+        result = emitter.RenderAliases(list(aliases.values()))
+        if emitter.MACROS_LOADER is None or macros_filename is None:
+            return result
+        CreateFile(macros_filename, result)
+        return emitter.MACROS_LOADER % macros_filename
+
+
+    CALLS_STATE_VERSION = 2
+
+    def RunCalls(self, state_filename, environ=None):
+        '''
+        Runs the calls (eg.: "git config --global" commands) whose command line changed since their
+        last successful execution, recorded in the state file by call key: calls with the same name
+        and different flags are distinct. The calls are executed in the resolved environment (see
+        Resolve).
+
+        :param unicode state_filename:
+        :param dict environ:
+            See Resolve.
+        :return list(tuple(unicode, int, unicode)):
+            The executed calls names, exit codes and output, in definition order.
+        '''
+        import subprocess
+
+        state = dict(self._LoadMarshal(state_filename, self.CALLS_STATE_VERSION) or {})
+        result = []
+        env = None
+        for i_key, i_command in six.iteritems(self.calls):
+            if state.get(i_key) == i_command:
+                continue
+            if env is None:
+                env = self._GetProcessEnviron(environ, append=True)
+            process = subprocess.Popen(
+                i_command,
+                shell=True,
+                env=env,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+            )
+            output = process.communicate()[0]
+            if process.returncode == 0:
+                state[i_key] = i_command
+            _flags, name = self.EnvVar._SplitName(i_key)
+            result.append((name, process.returncode, output.decode('UTF-8', 'replace')))
+
+        if any(retcode == 0 for (_name, retcode, _output) in result):
+            self._SaveMarshal(state_filename, self.CALLS_STATE_VERSION, state)
+        return result
+
+
+    def _ParseSections(self, contents):
+        '''
+        :param unicode contents:
+        :return tuple(list(tuple(unicode, object))):
+            The environment, aliases, calls and setup sections items, in the file order.
+        '''
+        import json
+        from collections import OrderedDict
+
+        data = json.loads(contents, object_pairs_hook=OrderedDict)
+        return tuple(
+            list(six.iteritems(data.get(i, {})))
+            for i in (
+                self.SECTION_ENVIRONMENT,
+                self.SECTION_ALIASES,
+                self.SECTION_CALLS,
+                self.SECTION_SETUP,
+            )
+        )
+
+
+    COMPILED_SUFFIX = '.cache'
+    COMPILED_VERSION = 4
+
+    # Compiled items already loaded by this process: {filename : (size, mtime, items)}. Keeps the
+    # configurations warm for long running processes (the shellmatic server).
+    _compiled = {}
+
+    def _LoadCompiled(self, filename):
+        '''
+        Returns the environment, aliases, calls and setup items of a JSON file from its compiled
+        cache.
+
+        The cache is stored next to the file (COMPILED_SUFFIX) in marshal format. It is valid while
+        the file size and modification time are unchanged or, if they changed, while the file
+        contents hash is the same. Otherwise the file is parsed and the cache rewritten.
+
+        Compiled items are also kept in memory, validated by the file size and modification time.
+
+        :param unicode filename:
+        :return tuple(list(tuple)):
+            The environment items, with the variable name as given (the key), its full name
+            including its resolved type and its value, the aliases pairs of name, including its
+            type, and value and the calls and setup pairs.
+        '''
+        import hashlib
+
+        cache_filename = filename + self.COMPILED_SUFFIX
+        stat = os.stat(filename)
+        memo = self._compiled.get(filename)
+        if memo is not None and memo[:2] == (stat.st_size, stat.st_mtime):
+            return memo[2]
+
+        size = mtime = digest = items = None
+        data = self._LoadMarshal(cache_filename, self.COMPILED_VERSION)
+        if data is not None:
+            (size, mtime, digest), items = data
+
+        if items is not None and (size, mtime) == (stat.st_size, stat.st_mtime):
+            self._compiled[filename] = (size, mtime, items)
+            return items
+
+        contents = GetFileContents(filename, binary=True)
+        new_digest = hashlib.sha1(contents).hexdigest()
+        if items is None or digest != new_digest:
+            environment, aliases, calls, setup = self._ParseSections(contents.decode('UTF-8'))
+            items = (
+                [
+                    (i_name, self.EnvVar(i_name, i_value).fullname, i_value)
+                    for (i_name, i_value) in environment
+                ],
+                [(self._GetAliasName(i_name), i_value) for (i_name, i_value) in aliases],
+                calls,
+                setup,
+            )
+
+        header = (stat.st_size, stat.st_mtime, new_digest)
+        self._SaveMarshal(cache_filename, self.COMPILED_VERSION, (header, items))
+        self._compiled[filename] = (stat.st_size, stat.st_mtime, items)
+        return items
+
+
+    SETUP_CACHE_VERSION = 3
+    SETUP_CACHE_FILENAME = '.shellmatic-setup.cache'
+
+    def LoadSetupScript(self, filename, args=(), flags=None, cache_filename=None, environ=None):
+        '''
+        Loads the environment changes made by an external setup script, such as vcvarsall.bat or
+        setvars.sh.
+
+        These scripts are slow, so the script runs only once: its changes are cached as typed items,
+        by script and arguments, and later loads replay them like LoadJson while the script contents
+        are the same.
+
+        Variables changed by the script are defined as text, except for path lists. The entries the
+        script adds to an existing path list (eg.: PATH) keep their place, before or after its
+        previous entries, referenced by the variable itself: the script must be loaded after the
+        configuration defining the original value. Variables removed by the script are ignored.
+
+        :param unicode filename:
+            A batch file on Windows, a (bash) shell script elsewhere.
+        :param list(unicode) args:
+            The script arguments.
+        :param list(unicode) flags:
+            Defaults to the script name (without extension), keeping its definitions apart from
+            the others of the same variables.
+        :param unicode cache_filename:
+            The captures cache file, shared by all the scripts. Defaults to SETUP_CACHE_FILENAME in
+            the user directory for application data (see _GetUserCacheDir): the scripts directory
+            is often read-only.
+        :param dict environ:
+            The environment the script runs on, by default os.environ.
+        '''
+        import hashlib
+
+        if flags is None:
+            flags = [self._GetSetupFlag(filename)]
+        if cache_filename is None:
+            cache_filename = os.path.join(self._GetUserCacheDir(), self.SETUP_CACHE_FILENAME)
+        # Scripts find their files relative to their own location (eg.: %~dp0).
+        key = (os.path.normcase(os.path.abspath(filename)), tuple(args))
+        digest = hashlib.sha1(GetFileContents(filename, binary=True)).hexdigest()
+
+        cache = dict(self._LoadMarshal(cache_filename, self.SETUP_CACHE_VERSION) or {})
+        cached_digest, items = cache.get(key, (None, None))
+        if cached_digest != digest:
+            items = self._CaptureSetupScript(filename, key[1], environ)
+            # Replaces the capture of the previous script contents.
+            cache[key] = (digest, items)
+            self._SaveMarshal(cache_filename, self.SETUP_CACHE_VERSION, cache)
+
+        for i_name, i_value in items:
+            name = ':'.join(sorted(flags) + [i_name])
+            self._Define(name, self.EnvVar(name, i_value, lazy=True))
+
+
+    @classmethod
+    def _GetSetupFlag(cls, filename):
+        '''
+        :return unicode:
+            The default flag of a setup script definitions: its name without extension.
+        '''
+        return os.path.splitext(os.path.basename(filename))[0].replace(':', '_')
+
+
+    @classmethod
+    def _GetUserCacheDir(cls):
+        '''
+        :return unicode:
+            The user directory for application data: $APPDATA, as the other shellmatic files, or
+            the user cache directory where it is not defined.
+        '''
+        result = os.environ.get('APPDATA')
+        if not result:
+            result = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+            try:
+                if not os.path.isdir(result):
+                    os.makedirs(result)
+            except OSError:
+                # Caches are optional (see _SaveMarshal).
+                pass
+        return result
+
+
+    # Variables changed by the shell itself, not by the setup scripts.
+    SETUP_IGNORED = ('PWD', 'OLDPWD')
+
+    def _CaptureSetupScript(self, filename, args, environ=None):
+        '''
+        Runs a setup script and returns the environment changes it made.
+
+        The changes are relative to the environment obtained the same way without the script,
+        excluding the variables the shell or the environment dump set themselves.
+
+        :return list(tuple(unicode, object)):
+            Pairs of variable full name, including its type, and value.
+        '''
+        environ = dict(os.environ if environ is None else environ)
+        before = self._DumpEnvironment(None, (), environ)
+        after = self._DumpEnvironment(filename, args, environ)
+        return self._GetEnvironmentDelta(before, after)
+
+
+    def _DumpEnvironment(self, filename, args, environ):
+        '''
+        :param unicode|None filename:
+            The setup script to execute before dumping the environment. None for none.
+        :param list(unicode) args:
+        :param dict environ:
+        :return Environ:
+            The environment after the script execution.
+        '''
+        import json
+        import subprocess
+        import sys
+
+        if sys.platform == 'win32':
+            if filename is None:
+                command = 'set'
+            else:
+                # The outer quotes are stripped by "cmd /s /c".
+                command = '""%s" %s > nul && set"' % (filename, subprocess.list2cmdline(args))
+            # The /u output is UTF-16: the ANSI code page can't represent every value.
+            output = subprocess.check_output('cmd /u /s /c ' + command, env=environ)
+            result = {}
+            for i_line in output.decode('UTF-16-LE').splitlines():
+                name, sep, value = i_line.partition('=')
+                # Skip the hidden drive variables (=C:=C:\).
+                if sep and name:
+                    result[name] = value
+            return self.Environ(result)
+
+        dump = 'import json, os, sys; sys.stdout.write(json.dumps(dict(os.environ)))'
+        command = '. "$0" "$@" > /dev/null && "%s" -c "%s"' % (sys.executable, dump)
+        output = subprocess.check_output(
+            ['bash', '-c', command, filename or os.devnull] + list(args),
+            env=environ,
+        )
+        return self.Environ(json.loads(output.decode('UTF-8')))
+
+
+    @classmethod
+    def _GetEnvironmentDelta(cls, before, after):
+        '''
+        :param Environ before:
+        :param Environ after:
+        :return list(tuple(unicode, object)):
+            The changed and new variables, see LoadSetupScript.
+        '''
+        result = []
+        for i_name, i_value in sorted(six.iteritems(after)):
+            old_value = before.get(i_name)
+            if i_value == old_value or i_name in cls.SETUP_IGNORED:
+                continue
+
+            flags = cls.EnvVar.DEFAULT_FLAGS.get(i_name, set())
+            if cls.EnvVar.TYPE_PATHLIST in flags or after.pathsep in i_value:
+                name = '%s:%s' % (cls.EnvVar.TYPE_PATHLIST, i_name)
+                result.append((name, cls._GetPathListDelta(i_name, old_value, i_value, after)))
+            else:
+                name = '%s:%s' % (cls.EnvVar.TYPE_TEXT, i_name)
+                result.append((name, i_value))
+        return result
+
+
+    @classmethod
+    def _GetPathListDelta(cls, name, old_value, value, environ):
+        '''
+        :param unicode name:
+        :param unicode|None old_value:
+        :param unicode value:
+        :param Environ environ:
+        :return list(unicode):
+            The new path-list paths. If the previous paths are all kept, together and in order,
+            they are replaced by a reference to the variable ($name) so that the new paths keep
+            their place, before or after them.
+        '''
+        paths = [i for i in value.split(environ.pathsep) if i]
+        if not old_value:
+            return paths
+
+        keys = [environ.GetPathKey(i) for i in paths]
+        old_keys = []
+        for i_key in environ.GetPathKeys(old_value):
+            if i_key not in old_keys:
+                old_keys.append(i_key)
+        if not set(old_keys).issubset(keys):
+            return paths
+
+        start = keys.index(old_keys[0])
+        end = start + len(old_keys)
+        if keys[start:end] != old_keys:
+            return paths
+        old_keys = set(old_keys)
+        return (
+            [i for (i, k) in zip(paths[:start], keys) if k not in old_keys] +
+            ['$' + name] +
+            [i for (i, k) in zip(paths[end:], keys[end:]) if k not in old_keys]
+        )
+
+
+    # Marshal files already loaded or saved by this process: {filename : (size, mtime, data)}.
+    # Keeps caches, indexes and states warm for long running processes (the shellmatic server).
+    _marshals = {}
+
+    @classmethod
+    def _LoadMarshal(cls, filename, version):
+        '''
+        :param unicode filename:
+        :param int version:
+            The expected data version.
+        :return object:
+            The data stored by _SaveMarshal, shared with the other loads: copy it before changing.
+            None if the file is missing, invalid or from another version.
+        '''
+        import marshal
+
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        memo = cls._marshals.get(filename)
+        if memo is None or memo[:2] != (stat.st_size, stat.st_mtime):
+            try:
+                with open(filename, 'rb') as marshal_file:
+                    memo = (stat.st_size, stat.st_mtime, marshal.loads(marshal_file.read()))
+            except (IOError, OSError, EOFError, ValueError, TypeError):
+                return None
+            cls._marshals[filename] = memo
+        try:
+            file_version, result = memo[2]
+        except (ValueError, TypeError):
+            return None
+        if file_version != version:
+            return None
+        return result
+
+
+    @classmethod
+    def _SaveMarshal(cls, filename, version, data):
+        import marshal
+
+        try:
+            with open(filename, 'wb') as marshal_file:
+                marshal_file.write(marshal.dumps((version, data)))
+            stat = os.stat(filename)
+        except (IOError, OSError):
+            # Caches and state files are optional, eg.: read-only installations.
+            cls._marshals.pop(filename, None)
+            return
+        cls._marshals[filename] = (stat.st_size, stat.st_mtime, (version, data))
+
+
+    def SaveJson(self, filename, flags=()):
+        '''
+        Saves the configuration in a JSON file.
+
+        :param unicode filename:
+        '''
+        import json
+
+        environment = {
+            i : v.value.AsJson()
+            for (i,v) in
+            six.iteritems(self.environment)
+        }
+        data = {
+            'environment' : environment,
+        }
+        contents = json.dumps(
+            data,
+            sort_keys=True,
+            indent=4,
+            separators=(',', ': '),
+            ensure_ascii=False
+        )
+        CreateFile(filename, contents, encoding='UTF-8')
+
+
+    def Workon(
+        self,
+        console_,
+        name,
+        config_filename=None,
+        cache_filename=None,
+        push=False,
+        environ=None,
+    ):
+        """
+        Activate a project's virtualenv.
+
+        The virtual environment must be placed on $PROJECTS_DIR/<name>/.venv
+
+        The activation is recorded in the activation stack (see STACK_VARIABLE) with the previous
+        values of the variables it changes, restored by Deactivate. Unless nesting (push), the
+        current activation is deactivated first.
+
+        :param name: The project name.
+        :param unicode config_filename:
+            The project configuration filename. Defaults to ENVIRONMENT_FILENAME.
+        :param unicode cache_filename:
+            If given, the project activation is obtained from this cache (see PrebuildProjects),
+            rebuilding and updating its entry if stale.
+        :param bool push:
+            If True the activation is nested, keeping the current activation.
+        :param dict environ:
+            The environment where the activation is executed. Defaults to os.environ.
+        :return bool:
+            False if the virtualenv was not found.
+        """
+        if environ is None:
+            environ = os.environ
+        if config_filename is None:
+            config_filename = self.ENVIRONMENT_FILENAME
+
+        cached = None
+        if cache_filename is not None:
+            cached = self._LoadProjectsCache(cache_filename).get(name)
+        project = self._BuildProject(name, config_filename, cached)
+        if project is None:
+            venv_home = self.PathValue('$PROJECTS_DIR/%(name)s/.venv' % locals())
+            console_.Print('{}: Unable to find virtualenv.'.format(venv_home.path))
+            return False
+        if cache_filename is not None and project is not cached:
+            self._UpdateProjectsCache(cache_filename, {name : project})
+        key, venv_home, loaded_filename, (environment, aliases, calls) = project
+
+        # Items were validated when built.
+        envvars = [
+            (i_name, self.EnvVar(i_name, i_value, lazy=True)) for (i_name, i_value) in environment
+        ]
+
+        # Unload previous virtualenv (if any)
+        stack = self._GetStack(environ)
+        base = self.Environ(environ)
+        if stack and not push:
+            old_name, frame = stack.pop()
+            # Variables set (not appended to) by the new activation are not restored.
+            replaced = self.Environ(
+                {
+                    j_envvar.name : ''
+                    for (_i_name, j_envvar) in envvars
+                    if not j_envvar.HasFlag(self.EnvVar.TYPE_PATHLIST)
+                },
+                platform=base.platform,
+            )
+            self._Restore(frame, base, skip=replaced)
+            console_.Print('%s: Deactivating virtualenv.' % old_name)
+
+        # Load new virtualenv and the environment configuration
+        for i_name, i_envvar in envvars:
+            self._Define(i_name, i_envvar)
+        for i_name, i_value in aliases:
+            self.AliasSet(i_name, i_value)
+        for i_name, i_value in calls:
+            self.CallSet(i_name, i_value)
+        console_.Print('%s: Activating virtualenv.' % venv_home)
+        if loaded_filename is not None:
+            console_.Print('%s: Loading configuration.' % loaded_filename)
+
+        # Record the changes: the paths added to path-lists, the previous values of the others.
+        resolved = self.Resolve(environ, append=True)
+        pathlists = self.Environ(
+            {
+                j_envvar.name : ''
+                for (_i_name, j_envvar) in envvars
+                if j_envvar.HasFlag(self.EnvVar.TYPE_PATHLIST)
+            },
+            platform=base.platform,
+        )
+        frame = []
+        for i_name, i_value in sorted(six.iteritems(resolved)):
+            previous = base.get(i_name) or None
+            if i_name == self.STACK_VARIABLE or (i_value or None) == previous:
+                continue
+            added = None
+            if i_name in pathlists:
+                added = self._GetAddedPaths(previous, i_value, base)
+            frame.append((i_name, previous, added))
+        stack.append((name, frame))
+        self._SetStack(stack)
 
         # Change directory to the project.
         #envout_.Call('cdd %(new_project_dir)s' % locals())
+        return True
+
+
+    def Deactivate(self, console_, environ=None):
+        '''
+        Deactivates the current virtualenv (see Workon), restoring the previous values of the
+        variables changed by its activation. The previous (nested) activation, if any, becomes the
+        current one.
+
+        :param dict environ:
+            The environment where the deactivation is executed. Defaults to os.environ.
+        :return bool:
+            False if no virtualenv is active.
+        '''
+        if environ is None:
+            environ = os.environ
+        stack = self._GetStack(environ)
+        if not stack:
+            console_.Print('No virtualenv active.')
+            return False
+        name, frame = stack.pop()
+        self._Restore(frame, self.Environ(environ))
+        self._SetStack(stack)
+        console_.Print('%s: Deactivating virtualenv.' % name)
+        return True
+
+
+    # The variable storing the activation stack in the shell environment: for each activation,
+    # the project name and the variables it changed, with their previous values and, for
+    # path-lists, the paths it added (see _Restore).
+    STACK_VARIABLE = 'SHELLMATIC_STACK'
+
+    @classmethod
+    def _GetStack(cls, environ):
+        '''
+        :param dict environ:
+        :return list(tuple(unicode, list(tuple(unicode, unicode|None, list|None)))):
+            The activation stack (see STACK_VARIABLE). Empty if missing or invalid.
+        '''
+        import base64
+        import json
+        import zlib
+
+        text = environ.get(cls.STACK_VARIABLE)
+        if not text:
+            return []
+        try:
+            stack = json.loads(zlib.decompress(base64.b64decode(text)).decode('UTF-8'))
+        except (ValueError, TypeError, zlib.error):
+            return []
+        # Frames entries without added paths are from older versions.
+        return [
+            (i_name, [(tuple(j) + (None,))[:3] for j in i_frame])
+            for (i_name, i_frame) in stack
+        ]
+
+
+    @classmethod
+    def _EncodeStack(cls, stack):
+        '''
+        :param list stack:
+            See _GetStack.
+        :return unicode:
+            The stack compressed and encoded in base64, safe for a BATCH set command.
+        '''
+        import base64
+        import json
+        import zlib
+
+        text = json.dumps(stack, separators=(',', ':'), ensure_ascii=False)
+        return base64.b64encode(zlib.compress(text.encode('UTF-8'))).decode('ascii')
+
+
+    def _SetStack(self, stack):
+        '''
+        :param list stack:
+            See _GetStack.
+        '''
+        value = self._EncodeStack(stack) if stack else ''
+        self.EnvironmentSet('_environ:text:nodep:' + self.STACK_VARIABLE, value)
+
+
+    def _Restore(self, frame, environ, skip=()):
+        '''
+        Undoes the changes of an activation frame: removes the paths it added to path-lists,
+        keeping the changes made since, and sets the other variables to their previous values.
+
+        :param list(tuple(unicode, unicode|None, list(unicode)|None)) frame:
+            See _GetStack.
+        :param Environ environ:
+            Updated with the restored values.
+        :param Environ|set(unicode) skip:
+            Variables not to set, only updated in the environ.
+        '''
+        for i_name, i_previous, i_added in frame:
+            if i_added is None:
+                value = i_previous or ''
+            else:
+                added_keys = {environ.GetPathKey(j) for j in i_added}
+                value = environ.pathsep.join(
+                    j
+                    for j in (environ.get(i_name) or '').split(environ.pathsep)
+                    if j and environ.GetPathKey(j) not in added_keys
+                )
+            if i_name not in skip:
+                self.EnvironmentSet('_environ:text:nodep:' + i_name, value)
+            environ[i_name] = value
+
+
+    @classmethod
+    def _GetAddedPaths(cls, previous, value, environ):
+        '''
+        :param unicode|None previous:
+        :param unicode value:
+        :param Environ environ:
+        :return list(unicode)|None:
+            The paths of the path-list value not in its previous value. None if previous paths were
+            removed: the path-list was set, not appended to.
+        '''
+        previous_keys = set(environ.GetPathKeys(previous or ''))
+        paths = [i for i in value.split(environ.pathsep) if i]
+        keys = [environ.GetPathKey(i) for i in paths]
+        if not previous_keys.issubset(keys):
+            return None
+        return [i for (i, k) in zip(paths, keys) if k not in previous_keys]
+
+
+    PROJECTS_CACHE_VERSION = 2
+
+    def _BuildProject(self, name, config_filename, cached=None):
+        '''
+        Builds the activation of a project: its virtualenv variables and configuration.
+
+        :param unicode name:
+        :param unicode config_filename:
+        :param tuple cached:
+            A previously built activation, returned as is if still valid.
+        :return tuple(unicode, unicode, unicode|None, tuple)|None:
+            The hash of the activation inputs, the virtualenv directory, the configuration file (if
+            any) and the environment, aliases and calls items (see _LoadCompiled). None if the
+            virtualenv is not found.
+        '''
+        import hashlib
+
+        # Obtain the new project and venv directories
+        new_project_dir = self.PathValue('$PROJECTS_DIR/%(name)s' % locals())
+        new_venv_home = self.PathValue('%(new_project_dir)s/.venv' % locals())
+        new_scripts_dir = self.PathValue('%(new_venv_home)s/scripts' % locals())
+
+        # Check if the new virtualenv really exists
+        if not new_venv_home.IsDir():
+            return None
+
+        new_config_filename = new_project_dir.path + '/' + config_filename
+        if os.path.isfile(new_config_filename):
+            contents = GetFileContents(new_config_filename, binary=True)
+        else:
+            new_config_filename = contents = None
+
+        key = hashlib.sha1(
+            repr((self.PROJECTS_CACHE_VERSION, name, new_venv_home.path)).encode('UTF-8')
+        )
+        if contents is not None:
+            key.update(contents)
+        key = key.hexdigest()
+        if cached is not None and cached[0] == key:
+            return cached
+
+        environment = [
+            (name + ':venv:PATH', new_scripts_dir.path),
+            (name + ':venv:VIRTUALENV', name),
+            (name + ':venv:PYTHONHOME', new_venv_home.path),
+        ]
+        aliases = calls = []
+        if contents is not None:
+            sections = self._ParseSections(contents.decode('UTF-8'))
+            sections = [[(name + ':' + j_name, j_value) for (j_name, j_value) in i] for i in sections]
+            environment += sections[0]
+            aliases = [(self._GetAliasName(i_name), i_value) for (i_name, i_value) in sections[1]]
+            calls = sections[2]
+        environment = [
+            (self.EnvVar(i_name, i_value).fullname, i_value) for (i_name, i_value) in environment
+        ]
+        return (key, new_venv_home.path, new_config_filename, (environment, aliases, calls))
+
+
+    def PrebuildProjects(self, cache_filename, config_filename=None, processes=None):
+        '''
+        Builds the activation (see Workon) of every project in $PROJECTS_DIR, in parallel, storing
+        them in the cache. Only the projects whose inputs (virtualenv and configuration) changed are
+        built again.
+
+        :param unicode cache_filename:
+        :param unicode config_filename:
+            See Workon.
+        :param int processes:
+            The number of worker processes. Defaults to the number of CPUs.
+        :return list(unicode):
+            The names of the projects with a virtualenv.
+        '''
+        from multiprocessing import Pool
+
+        if config_filename is None:
+            config_filename = self.ENVIRONMENT_FILENAME
+
+        projects_dir = self.PathValue('$PROJECTS_DIR').path
+        names = sorted(
+            i for i in os.listdir(projects_dir) if os.path.isdir(os.path.join(projects_dir, i))
+        )
+        cache = self._LoadProjectsCache(cache_filename)
+        pool = Pool(processes)
+        try:
+            projects = pool.map(
+                _BuildProjectWorker,
+                [(i, config_filename, cache.get(i)) for i in names]
+            )
+        finally:
+            pool.close()
+            pool.join()
+
+        cache = {i : v for (i, v) in zip(names, projects) if v is not None}
+        self._UpdateProjectsCache(cache_filename, cache, replace=True)
+        return sorted(cache)
+
+
+    @classmethod
+    def _LoadProjectsCache(cls, cache_filename):
+        '''
+        :return dict(unicode, tuple):
+            The projects activations (see _BuildProject) by name. Empty if the cache is missing or
+            invalid.
+        '''
+        return cls._LoadMarshal(cache_filename, cls.PROJECTS_CACHE_VERSION) or {}
+
+
+    @classmethod
+    def _UpdateProjectsCache(cls, cache_filename, projects, replace=False):
+        '''
+        :param dict(unicode, tuple) projects:
+            The projects activations to store.
+        :param bool replace:
+            If True the cache contains only the given projects, otherwise they are added to it.
+        '''
+        cache = {} if replace else dict(cls._LoadProjectsCache(cache_filename))
+        cache.update(projects)
+        cls._SaveMarshal(cache_filename, cls.PROJECTS_CACHE_VERSION, cache)
 
 
     def PrintList(self, console_, logo=True):
@@ -594,3 +3247,42 @@ class Shellmatic(object):
             console_.Print('<green>%s</>' % i_flags)
             for j_envvar in i_envvars:
                 console_.Item('<white>%s</>: %s' % (j_envvar.name, j_envvar.value.AsPrint()), indent=1)
+
+
+
+def _BuildProjectWorker(args):
+    '''
+    Shellmatic._BuildProject for Shellmatic.PrebuildProjects worker processes.
+    '''
+    return Shellmatic()._BuildProject(*args)
+
+
+def _ScanDir(directory):
+    '''
+    Lists a directory, for the indexes (see Shellmatic.ProjectIndex and ExecutableIndex).
+
+    :return list(tuple(unicode, bool, float)):
+        The directory entries names, if they are directories and their modification time (only for
+        directories).
+    '''
+    try:
+        from os import scandir
+    except ImportError:
+        try:
+            from scandir import scandir
+        except ImportError:
+            scandir = None
+
+    if scandir is None:
+        result = []
+        for i_name in os.listdir(directory):
+            path = os.path.join(directory, i_name)
+            is_dir = os.path.isdir(path)
+            result.append((i_name, is_dir, os.stat(path).st_mtime if is_dir else None))
+        return result
+
+    result = []
+    for i_entry in scandir(directory):
+        is_dir = i_entry.is_dir()
+        result.append((i_entry.name, is_dir, i_entry.stat().st_mtime if is_dir else None))
+    return result
@@ -3,9 +3,10 @@ from ben10.filesystem import CreateDirectory, CreateFile
 from ben10.foundation.string import Dedent
 from ben10.foundation.types_ import Null
 from clikit.console import BufferedConsole
-from shellmatic import Shellmatic
+from shellmatic import CyclicDependencyError, Shellmatic
 import os
 import pytest
+import re
 import six
 
 
@@ -21,6 +22,21 @@ def testEnvVarRepr():
     assert repr(Shellmatic.EnvVar('windows:pathlist:PATH', 'c:/windows/system32')) == '<EnvVar pathlist:windows:PATH>'
 
 
+def testEnvVarFlags():
+    a = Shellmatic.EnvVar('windows:alpha:text:nodep:PROMPT', '$P$G')
+    assert a.flags == {'windows', 'alpha', 'text', 'nodep'}
+    assert a.HasFlag('nodep')
+    assert a.HasFlag('windows')
+    assert not a.HasFlag('path')
+    assert not a.HasFlag('bravo')
+    assert a.fullname == 'alpha:nodep:text:windows:PROMPT'
+
+    b = Shellmatic.EnvVar('alpha:windows:path:HOME', '')
+    assert b._user_flags is a._user_flags
+    with pytest.raises(AttributeError):
+        b.extra = 'extra'
+
+
 def testEnvVarCompare():
     a = Shellmatic.EnvVar('ALPHA', '')
     b = Shellmatic.EnvVar('BRAVO', '')
@@ -40,6 +56,13 @@ def testEnvVarGetDependencies():
     a = Shellmatic.EnvVar('nodep:ALPHA', '$ALPHA/bravo/$CHARLIE')
     assert a.GetDependencies() == set()
 
+    # Lazy variables are not resolved.
+    a = Shellmatic.EnvVar('pathlist:PATH', ['$Alpha/bin', 'x:/bravo;$CHARLIE'], lazy=True)
+    assert a.GetDependencies() == {'ALPHA', 'CHARLIE'}
+    a = Shellmatic.EnvVar('PROMPT', '$P$G', lazy=True)
+    assert a.GetDependencies() == set()
+    assert a._lazy
+
 
 def testEnvVarAsBatch():
     # Default type "path" will handle both slashes and environment variables expansions.
@@ -66,6 +89,12 @@ def testLoadEnvironment():
 
     s.LoadEnvironment(environ)
 
+    # Variables types and values are only resolved when used.
+    assert [i._lazy for i in six.itervalues(s.environment)] == [True, True, True]
+    assert s.environment['_environ:BYTES'].value.AsList() == ['alpha']
+    assert not s.environment['_environ:BYTES']._lazy
+    assert s.environment['_environ:PATH']._lazy
+
     obtained = sorted([(i.name, i.flags, i.value.AsList()) for i in sorted(six.itervalues(s.environment))])
     expected = [
         (
@@ -159,6 +188,411 @@ def testAsBatch():
         s.AsBatch(Null())
 
 
+def testDependencyGraph():
+    graph = Shellmatic.DependencyGraph(
+        [
+            ('ALPHA', {'CHARLIE'}),
+            ('BRAVO', set()),
+            ('CHARLIE', {'BRAVO', 'CHARLIE', 'UNDEFINED'}),
+            ('DELTA', {'ALPHA'}),
+        ]
+    )
+    assert graph.TopologicalSort() == ['BRAVO', 'CHARLIE', 'ALPHA', 'DELTA']
+
+    graph = Shellmatic.DependencyGraph(
+        [
+            ('ALPHA', {'BRAVO'}),
+            ('BRAVO', {'CHARLIE'}),
+            ('CHARLIE', {'ALPHA'}),
+            ('DELTA', {'ALPHA'}),
+            ('ECHO', {'FOXTROT'}),
+            ('FOXTROT', {'ECHO'}),
+        ]
+    )
+    with pytest.raises(CyclicDependencyError) as e:
+        graph.TopologicalSort()
+    assert e.value.cycles == [
+        ['ALPHA', 'BRAVO', 'CHARLIE', 'ALPHA'],
+        ['ECHO', 'FOXTROT', 'ECHO'],
+    ]
+    assert six.text_type(e.value) == \
+        'Cyclic dependency detected: ALPHA -> BRAVO -> CHARLIE -> ALPHA; ECHO -> FOXTROT -> ECHO.'
+
+
+def testAsBatchIncremental(monkeypatch):
+    s = Shellmatic()
+    s.EnvironmentSet('path:SHARED_DIR', 'd:/shared')
+    s.EnvironmentSet('path:PYTHONHOME', '$SHARED_DIR/python27')
+    s.EnvironmentSet('system:pathlist:PATH', ['c:/windows'])
+    s.EnvironmentSet('python:pathlist:PATH', ['$PYTHONHOME'])
+    assert s.AsBatch(Null()) == Dedent(
+        '''
+        set SHARED_DIR=d:\\shared
+        set PYTHONHOME=%SHARED_DIR%\\python27
+        set PATH=c:\\windows
+        set PATH=%PATH%;%PYTHONHOME%
+        '''
+    )
+
+    generated = []
+    original_get_dependencies = Shellmatic.EnvVar.GetDependencies
+    def GetDependencies(envvar):
+        generated.append(envvar.name)
+        return original_get_dependencies(envvar)
+    monkeypatch.setattr(Shellmatic.EnvVar, 'GetDependencies', GetDependencies)
+
+    rendered = []
+    original_create_assignment = Shellmatic._CreateAssignment
+    def CreateAssignment(self, envvar, value, append):
+        rendered.append(envvar.name)
+        return original_create_assignment(self, envvar, value, append)
+    monkeypatch.setattr(Shellmatic, '_CreateAssignment', CreateAssignment)
+
+    # Only the changed variables dependencies and assignments are obtained again.
+    s.EnvironmentSet('path:SHARED_DIR', 'x:/shared')
+    s.EnvironmentSet('python:pathlist:PATH', ['$PYTHONHOME', '$PYTHONHOME/scripts'])
+    assert s.AsBatch(Null()) == Dedent(
+        '''
+        set SHARED_DIR=x:\\shared
+        set PYTHONHOME=%SHARED_DIR%\\python27
+        set PATH=c:\\windows
+        set PATH=%PATH%;%PYTHONHOME%;%PYTHONHOME%\\scripts
+        '''
+    )
+    assert sorted(generated) == ['PATH', 'PATH', 'SHARED_DIR']
+    assert sorted(rendered) == ['PATH', 'PATH', 'SHARED_DIR']
+
+    # Changing an environment reuses the assignments of the values set as defined: only the PATH
+    # part missing from the environment is rendered again.
+    s.AsBatch(Null(), environ={'PATH' : 'c:\\windows'})
+    del rendered[:]
+    s.AsBatch(Null(), environ={'PATH' : 'c:\\windows', 'SHARED_DIR' : 'x:\\shared'})
+    assert rendered == ['PATH']
+
+    # New dependencies reorder the variables.
+    del generated[:]
+    s.EnvironmentSet('path:SHARED_DIR', '$PROJECTS_DIR/shared')
+    s.EnvironmentSet('path:PROJECTS_DIR', 'x:/projects')
+    assert s.AsBatch(Null()) == Dedent(
+        '''
+        set PROJECTS_DIR=x:\\projects
+        set SHARED_DIR=%PROJECTS_DIR%\\shared
+        set PYTHONHOME=%SHARED_DIR%\\python27
+        set PATH=c:\\windows
+        set PATH=%PATH%;%PYTHONHOME%;%PYTHONHOME%\\scripts
+        '''
+    )
+    assert sorted(generated) == ['PROJECTS_DIR', 'SHARED_DIR']
+
+
+def testGetOrderIncremental():
+    import random
+
+    # The incremental order is always the one of sorting all the variables.
+    def Check(s):
+        order = s._GetOrder()
+        assert s._dependencies == {
+            i : set().union(*[s.environment[j].GetDependencies() for j in keys])
+            for (i, keys) in six.iteritems(s._groups)
+        }
+        sources = sorted(six.iteritems(s._dependencies))
+        assert order == Shellmatic.DependencyGraph(sources).TopologicalSort()
+
+    rand = random.Random(5)
+    names = ['V%02d' % i for i in range(30)]
+    s = Shellmatic()
+    for i_step in range(200):
+        name = rand.choice(names)
+        # Only references to the previous names: no cycles.
+        references = rand.sample(names[:names.index(name)], min(names.index(name), 2))
+        s.EnvironmentSet('text:' + name, ''.join('$' + i for i in references))
+        if i_step % 20 == 0:
+            s.PushLayer('layer')
+        elif i_step % 20 == 10:
+            s.PopLayer()
+        if i_step % 3 == 0:
+            Check(s)
+
+    # Cycles are reported, and fixed.
+    s.EnvironmentSet('text:V00', '$V29')
+    s.EnvironmentSet('text:V29', '$V00')
+    with pytest.raises(CyclicDependencyError):
+        s._GetOrder()
+    s.EnvironmentSet('text:V00', '')
+    Check(s)
+
+
+def testAsBatchDelta():
+    s = Shellmatic()
+    s.EnvironmentSet('path:SHARED_DIR', 'd:/shared')
+    s.EnvironmentSet('text:TERM', 'msys')
+    s.EnvironmentSet('text:nodep:PROMPT', '$P$G')
+    s.EnvironmentSet('system:pathlist:PATH', ['c:/windows'])
+    s.EnvironmentSet('python:pathlist:PATH', ['$SHARED_DIR/python27', 'c:/Windows'])
+
+    environ = {
+        'Shared_Dir' : 'D:\\Shared',
+        'TERM' : 'cygwin',
+        'PROMPT' : '$P$G',
+        'PATH' : 'c:\\windows',
+    }
+    assert s.AsBatch(Null(), environ=environ) == Dedent(
+        '''
+        set TERM=msys
+        set PATH=%PATH%;%SHARED_DIR%\\python27
+        '''
+    )
+
+    # Appending to path-lists is idempotent.
+    environ['PATH'] = 'c:\\windows;d:\\shared\\python27'
+    environ['TERM'] = 'msys'
+    assert s.AsBatch(Null(), environ=environ) == ''
+
+    assert s.AsBatch(Null(), append=True, environ={'PATH' : 'x:/bravo'}) == Dedent(
+        '''
+        set PROMPT=$P$G
+        set SHARED_DIR=d:\\shared
+        set TERM=msys
+        set PATH=%PATH%;c:\\windows
+        set PATH=%PATH%;%SHARED_DIR%\\python27
+        '''
+    )
+
+
+def testAsBatchCoalesce():
+    s = Shellmatic()
+    s.LoadJson(os.path.join(os.path.dirname(__file__), 'test.json'))
+    s.EnvironmentSet('jython:pathlist:PATH', ['$SHARED_DIR/jython', '$PATH/jython'])
+    s.EnvironmentSet('pathlist:PYTHONPATH', ['x:/alpha'])
+    s.EnvironmentSet('bravo:pathlist:PYTHONPATH', ['x:/bravo'])
+
+    assert s.AsBatch(Null(), append=True, coalesce=True) == Dedent(
+        '''
+        set PROJECTS_DIR=x:
+        set PYTHONPATH=%PYTHONPATH%;x:\\alpha;x:\\bravo
+        set SHARED_DIR=d:\\shared
+        set PYTHONHOME=%SHARED_DIR%\\python27
+        set PATH=%PATH%;%PYTHONHOME%;%PYTHONHOME%\\scripts
+        set PATH=%PATH%;%SHARED_DIR%\\jdk\\bin
+        set PATH=%PATH%;%SHARED_DIR%\\jython;%PATH%\\jython
+        '''
+    )
+
+    def Execute(script, environ):
+        environ = Shellmatic.BatchEnviron(environ)
+        for i_line in script.splitlines():
+            name, value = i_line[len('set '):].split('=', 1)
+            environ[name] = re.sub(r'%(\w+)%', lambda m: environ.get(m.group(1), m.group(0)), value)
+        return environ
+
+    # The same results.
+    for i_environ in ({}, {'PATH' : 'c:\\windows', 'PYTHONPATH' : 'x:\\alpha'}):
+        for i_append in (False, True):
+            for i_delta in (None, i_environ):
+                scripts = [
+                    s.AsBatch(Null(), append=i_append, environ=i_delta, coalesce=j_coalesce)
+                    for j_coalesce in (False, True)
+                ]
+                assert Execute(scripts[0], i_environ) == Execute(scripts[1], i_environ)
+
+
+def testEmitters():
+    import subprocess
+
+    s = Shellmatic()
+    s.LoadJson(os.path.join(os.path.dirname(__file__), 'test.json'))
+    s.EnvironmentSet('text:nodep:PROMPT', '$P$G')
+    s.EnvironmentSet('text:EMPTY', '')
+
+    # The cmd emitter generates the same as AsBatch.
+    for i_append in (False, True):
+        for i_environ in (None, {}, {'PATH' : 'c:\\windows', 'SHARED_DIR' : 'd:\\shared'}):
+            for i_coalesce in (False, True):
+                kwargs = dict(append=i_append, environ=i_environ, coalesce=i_coalesce)
+                assert s.AsScript('cmd', **kwargs) == s.AsBatch(Null(), **kwargs)
+
+    scripts = s.AsScripts(['bash', 'fish', 'powershell'], append=True, coalesce=True)
+    assert scripts['bash'] == Dedent(
+        '''
+        unset EMPTY
+        export PROJECTS_DIR="x:"
+        export PROMPT="\\$P\\$G"
+        export SHARED_DIR="d:/shared"
+        export PYTHONHOME="${SHARED_DIR}/python27"
+        export PATH="${PATH:+${PATH}:}${PYTHONHOME}:${PYTHONHOME}/scripts:${SHARED_DIR}/jdk/bin"
+        '''
+    )
+    assert scripts['fish'] == Dedent(
+        '''
+        set -e EMPTY
+        set -gx PROJECTS_DIR "x:"
+        set -gx PROMPT "\\$P\\$G"
+        set -gx SHARED_DIR "d:/shared"
+        set -gx PYTHONHOME "$SHARED_DIR""/python27"
+        set -gx PATH $PATH "$PYTHONHOME" "$PYTHONHOME""/scripts" "$SHARED_DIR""/jdk/bin"
+        '''
+    )
+    assert scripts['powershell'] == Dedent(
+        '''
+        Remove-Item Env:EMPTY -ErrorAction SilentlyContinue
+        ${env:PROJECTS_DIR} = "x:"
+        ${env:PROMPT} = "`$P`$G"
+        ${env:SHARED_DIR} = "d:\\shared"
+        ${env:PYTHONHOME} = "${env:SHARED_DIR}\\python27"
+        ${env:PATH} = "${env:PATH};${env:PYTHONHOME};${env:PYTHONHOME}\\scripts;${env:SHARED_DIR}\\jdk\\bin"
+        '''
+    )
+
+    if os.path.isfile('/bin/bash'):
+        output = subprocess.check_output(
+            ['/bin/bash', '-c', scripts['bash'] + '\necho "$PATH|$PROMPT|${EMPTY-unset}"'],
+            env={'PATH' : '/bin', 'EMPTY' : 'empty'},
+        )
+        assert output.decode('ascii').strip() == \
+            '/bin:d:/shared/python27:d:/shared/python27/scripts:d:/shared/jdk/bin|$P$G|unset'
+
+    # Changing an environment follows the conventions of each shell platform.
+    s = Shellmatic()
+    s.EnvironmentSet('pathlist:PATH', ['/opt/bin'])
+    scripts = s.AsScripts(['bash', 'cmd'], append=True, environ={'PATH' : '/usr/bin:/opt/bin'})
+    assert scripts == {'bash' : '', 'cmd' : 'set PATH=%PATH%;\\opt\\bin'}
+
+
+def testAsBatchRoots():
+    s = Shellmatic()
+    s.LoadJson(os.path.join(os.path.dirname(__file__), 'test.json'))
+    s.EnvironmentSet('path:JAVA_HOME', '$SHARED_DIR/jdk')
+
+    assert s.AsBatch(Null(), roots=['pythonhome']) == Dedent(
+        '''
+        set SHARED_DIR=d:\\shared
+        set PYTHONHOME=%SHARED_DIR%\\python27
+        '''
+    )
+    assert s.GetReachable(['PATH', 'UNKNOWN']) == {'PATH', 'PYTHONHOME', 'SHARED_DIR'}
+    assert s.AsBatch(Null(), roots=[]) == ''
+
+    assert s.Analyze(['PATH']) == (['JAVA_HOME', 'PROJECTS_DIR'], ['JAVA_HOME', 'PROJECTS_DIR'])
+    assert s.Analyze(['JAVA_HOME']) == (['PATH', 'PROJECTS_DIR', 'PYTHONHOME'], ['PATH', 'PROJECTS_DIR'])
+
+
+def testLayers():
+    s = Shellmatic()
+    s.EnvironmentSet('path:SHARED_DIR', 'd:/Shared')
+    s.EnvironmentSet('path:PYTHONHOME', '$SHARED_DIR/python27')
+    s.AliasSet('ll', 'ls -l')
+    s.CallSet('git:hooks', 'git config core.hooksPath .hooks')
+    base = s.AsBatch(Null())
+    environment = list(s.environment.items())
+    aliases = list(s.alias.items())
+    calls = list(s.calls.items())
+
+    s.PushLayer('project')
+    s.AliasSet('ll', 'ls -la')
+    s.AliasSet('la', 'ls -a')
+    s.CallSet('git:hooks', 'git config core.hooksPath project/.hooks')
+    s.CallSet('git:email', 'git config user.email project@example.com')
+    s.EnvironmentSet('path:PYTHONHOME', '$SHARED_DIR/python34')
+    s.EnvironmentSet('path:PROJECT_DIR', '$PYTHONHOME/project')
+    s.EnvironmentSet('pathlist:PATH', ['$PROJECT_DIR/bin'])
+    assert s.layers == ['project']
+    assert s.AsBatch(Null()) == Dedent(
+        '''
+        set SHARED_DIR=d:\\shared
+        set PYTHONHOME=%SHARED_DIR%\\python34
+        set PROJECT_DIR=%PYTHONHOME%\\project
+        set PATH=%PROJECT_DIR%\\bin
+        '''
+    )
+
+    snapshot = s.Snapshot()
+    s.EnvironmentSet('path:PROJECT_DIR', 'x:/project')
+    s.PushLayer('session')
+    s.EnvironmentSet('text:ALPHA', 'Alpha')
+    assert s.layers == ['project', None, 'session']
+    s.Rollback(snapshot)
+    assert s.layers == ['project']
+    assert 'set PROJECT_DIR=%PYTHONHOME%\\project' in s.AsBatch(Null())
+
+    assert s.PopLayer() == 'project'
+    assert s.layers == []
+    assert list(s.environment.items()) == environment
+    assert s.AsBatch(Null()) == base
+    # Aliases and calls are undone too, keeping their place.
+    assert list(s.alias.items()) == aliases
+    assert list(s.calls.items()) == calls
+
+
+def testResolve(monkeypatch):
+    monkeypatch.setenv('PATH', os.path.normpath('/bin'))
+    monkeypatch.setenv('http_proxy', 'proxy:8080')
+
+    s = Shellmatic()
+    s.EnvironmentSet('path:SHARED_DIR', '/opt/Shared')
+    s.EnvironmentSet('path:PYTHONHOME', '$shared_dir/python27')
+    s.EnvironmentSet('python:pathlist:PATH', ['$PYTHONHOME', '$PYTHONHOME/scripts'])
+
+    # The environment as processes see it.
+    resolved = s.Resolve()
+    python_home = os.path.normpath('/opt/Shared/python27')
+    assert resolved['SHARED_DIR'] == os.path.normpath('/opt/Shared')
+    assert resolved['PYTHONHOME'] == python_home
+    assert resolved['PATH'] == os.pathsep.join([python_home, os.path.join(python_home, 'scripts')])
+    assert resolved['http_proxy'] == 'proxy:8080'
+    assert s.Resolve(append=True)['PATH'] == os.pathsep.join(
+        [os.path.normpath('/bin'), python_home, os.path.join(python_home, 'scripts')]
+    )
+    assert Shellmatic.PathValue('$PythonHome/lib').ExpandVars(resolved).AsPrint() == \
+        '/opt/Shared/python27/lib'
+
+    # Windows conventions: case insensitive names, ";" separated paths, compared ignoring case.
+    environ = Shellmatic.BatchEnviron({'Path' : 'c:\\windows;\\OPT\\shared\\Python27'})
+    assert s.Resolve(environ, append=True)['path'] == \
+        'c:\\windows;\\OPT\\shared\\Python27;\\opt\\Shared\\python27\\scripts'
+
+    # Memoized until the environment changes.
+    assert s.Resolve() == resolved
+    resolved_ = s._resolved
+    assert s.Resolve() == resolved
+    assert s._resolved is resolved_
+
+    s.EnvironmentSet('path:SHARED_DIR', '/opt/other')
+    assert s.Resolve()['PYTHONHOME'] == os.path.normpath('/opt/other/python27')
+    assert s._resolved is not resolved_
+
+
+def testRun(monkeypatch, embed_data):
+    import _ii
+    import sys
+
+    monkeypatch.setenv('PROJECTS_DIR', embed_data.GetDataDirectory())
+    monkeypatch.setenv('APPDATA', embed_data.GetDataDirectory())
+    monkeypatch.delenv('VIRTUALENV', raising=False)
+    # The venv PYTHONHOME must be a working python installation for the child processes.
+    CreateDirectory(embed_data['alpha'])
+    os.symlink(getattr(sys, 'base_prefix', sys.prefix), embed_data['alpha/.venv'])
+    CreateFile(embed_data['alpha/.eladrin.json'], '{"environment": {"text:ALPHA_CONFIG": "eladrin"}}')
+
+    s = Shellmatic()
+    s.EnvironmentSet('text:ALPHA', 'Alpha')
+    script = 'import os, sys; sys.exit(os.environ["ALPHA"] == "Alpha" and 3)'
+    assert s.Run([sys.executable, '-c', script]) == 3
+    assert 'ALPHA' not in os.environ
+
+    # ii run <name> -- <command>: the same activation as ii workon.
+    script = 'import os, sys; ' \
+        'sys.exit(os.environ["VIRTUALENV"] == "alpha" and os.environ["ALPHA_CONFIG"] == "eladrin" and 4)'
+    console = BufferedConsole()
+    with pytest.raises(SystemExit) as e:
+        _ii.FastMain(['run', 'alpha', '--', sys.executable, '-c', script], console)
+    assert e.value.code == 4
+    assert 'VIRTUALENV' not in os.environ
+
+    assert _ii.Run(console, Shellmatic(), _ii.Config(), 'bravo', 'python') == 1
+    assert not _ii.FastMain(['run', 'alpha', sys.executable, '-c', script], console)
+    assert not _ii.ClientMain(['run', 'alpha', '--', sys.executable])
+
+
 def testReset():
     s = Shellmatic()
     filename = os.path.join(os.path.dirname(__file__), 'test.json')
@@ -176,12 +610,472 @@ def testReset():
     assert obtained == expected
 
 
+def testLoadJsonCache(embed_data):
+    filename = embed_data['alpha.json']
+    CreateFile(filename, '{"environment": {"ALPHA": "x:/alpha", "PATH": ["$ALPHA/bin"]}}')
+
+    def LoadJson(cache):
+        s = Shellmatic()
+        s.LoadJson(filename, flags=('alpha',), cache=cache)
+        return s.AsBatch(Null())
+
+    expected = Dedent(
+        '''
+        set ALPHA=x:\\alpha
+        set PATH=%ALPHA%\\bin
+        '''
+    )
+    assert LoadJson(cache=False) == expected
+    assert LoadJson(cache=True) == expected
+    assert os.path.isfile(filename + Shellmatic.COMPILED_SUFFIX)
+    assert LoadJson(cache=True) == expected
+
+    # Cached and uncached loads define the same variables.
+    s = Shellmatic()
+    s.LoadJson(filename, cache=True)
+    s.LoadJson(filename)
+    assert sorted(s.environment) == ['ALPHA', 'PATH']
+
+    CreateFile(filename, '{"environment": {"text:ALPHA": "x:/Bravo"}}')
+    assert LoadJson(cache=True) == 'set ALPHA=x:/Bravo'
+
+    # Corrupted caches are recompiled.
+    CreateFile(filename + Shellmatic.COMPILED_SUFFIX, 'corrupted')
+    assert LoadJson(cache=True) == 'set ALPHA=x:/Bravo'
+
+
+@pytest.mark.skipif(os.name == 'nt', reason='Uses a bash setup script')
+def testLoadSetupScript(embed_data, monkeypatch):
+    monkeypatch.setenv('APPDATA', embed_data['appdata'])
+    CreateDirectory(embed_data['appdata'])
+    filename = embed_data['setvars.sh']
+    runs_filename = embed_data['runs.txt']
+    CreateFile(
+        filename,
+        Dedent(
+            '''
+            echo run >> "%(runs_filename)s"
+            export TOOL_ROOT=/opt/tool-$1
+            export PATH="$PATH:$TOOL_ROOT/bin"
+            export MANPATH="$TOOL_ROOT/man:$MANPATH"
+            export TOOL_LIBS=/opt/a:/opt/b
+            cd /
+            echo "setup output is ignored"
+            '''
+        ) % locals()
+    )
+    environ = {'PATH' : '/usr/bin:/bin', 'MANPATH' : '/usr/man', 'KEPT' : 'kept'}
+
+    def LoadSetupScript(*args):
+        s = Shellmatic()
+        s.EnvironmentSet('pathlist:PATH', '/usr/bin:/bin'.split(':'))
+        s.EnvironmentSet('pathlist:MANPATH', ['/usr/share/man'])
+        s.LoadSetupScript(filename, args, environ=environ)
+        return s.Resolve({})
+
+    def GetRuns():
+        with open(runs_filename) as runs_file:
+            return len(runs_file.readlines())
+
+    expected = LoadSetupScript('1.0')
+    assert expected['TOOL_ROOT'] == '/opt/tool-1.0'
+    assert expected['PATH'] == '/usr/bin:/bin:/opt/tool-1.0/bin'
+    # Prepended paths keep their place.
+    assert expected['MANPATH'] == '/opt/tool-1.0/man:/usr/share/man'
+    assert expected['TOOL_LIBS'] == '/opt/a:/opt/b'
+    # Unchanged and shell variables are not captured.
+    assert set(expected) == {'PATH', 'MANPATH', 'TOOL_ROOT', 'TOOL_LIBS'}
+    assert GetRuns() == 1
+
+    # Replayed from the cache, kept with the user data: not next to the script.
+    assert LoadSetupScript('1.0') == expected
+    assert GetRuns() == 1
+    assert os.path.isfile(embed_data['appdata/' + Shellmatic.SETUP_CACHE_FILENAME])
+    assert sorted(os.listdir(os.path.dirname(filename))) == ['appdata', 'runs.txt', 'setvars.sh']
+
+    # Other arguments or script contents run the script again.
+    assert LoadSetupScript('2.0')['TOOL_ROOT'] == '/opt/tool-2.0'
+    assert GetRuns() == 2
+    CreateFile(filename, 'export TOOL_ROOT=/opt/tool')
+    assert LoadSetupScript('1.0')['TOOL_ROOT'] == '/opt/tool'
+    assert GetRuns() == 2
+
+    # Configuration files list the setup scripts to load.
+    monkeypatch.setenv('SETUP_DIR', os.path.dirname(filename))
+    config_filename = embed_data['setup.json']
+    CreateFile(
+        config_filename,
+        '''
+        {
+            "environment": {"pathlist:PATH": ["/usr/bin", "/bin"]},
+            "setup": {"$SETUP_DIR/setvars.sh": ["1.0"]}
+        }
+        '''
+    )
+    for i_cache in (False, True, True):
+        s = Shellmatic()
+        s.LoadJson(config_filename, flags=('tools',), cache=i_cache)
+        assert s.Resolve({})['TOOL_ROOT'] == '/opt/tool'
+        assert 'setvars:tools:text:TOOL_ROOT' in s.environment
+    assert GetRuns() == 2
+
+
+def testAliases(monkeypatch, embed_data):
+    filename = embed_data['aliases.json']
+    CreateFile(
+        filename,
+        '''
+        {
+            "aliases": {
+                "windows:cat": "type",
+                "posix:ll": "ls -l",
+                "vim:path:vi": "$SHARED_DIR/vim/gvim.exe",
+                "nodep:price": "echo $5"
+            },
+            "environment": {"path:SHARED_DIR": "d:/shared"}
+        }
+        '''
+    )
+
+    for i_cache in (False, True, True):
+        s = Shellmatic()
+        s.LoadJson(filename, cache=i_cache)
+        assert list(s.alias) == ['text:windows:cat', 'text:posix:ll', 'vim:path:vi', 'text:nodep:price']
+
+        macros_filename = embed_data['macros.doskey']
+        assert s.AsAliases('cmd', macros_filename) == 'doskey /macrofile="%s"' % macros_filename
+        with open(macros_filename) as macros_file:
+            assert macros_file.read() == Dedent(
+                '''
+                cat=type $*
+                vi="%SHARED_DIR%\\vim\\gvim.exe" $*
+                price=echo $$5 $*
+                '''
+            )
+        assert s.AsAliases('bash') == Dedent(
+            '''
+            alias ll="ls -l"
+            alias vi="\\"${SHARED_DIR}/vim/gvim.exe\\""
+            alias price="echo \\$5"
+            '''
+        )
+        assert s.AsAliases('fish') == Dedent(
+            '''
+            alias ll "ls -l"
+            alias vi "'""$SHARED_DIR""/vim/gvim.exe""'"
+            alias price "echo \\$5"
+            '''
+        )
+        assert s.AsAliases('powershell').splitlines()[0] == (
+            'Remove-Item Alias:cat -Force -ErrorAction SilentlyContinue; '
+            'function global:cat { type @args }'
+        )
+
+    assert Shellmatic().AsAliases('cmd') == ''
+
+    # Testing shows the macros, without writing the macros file.
+    import _ii
+    monkeypatch.setenv('APPDATA', embed_data['appdata'])
+    monkeypatch.setenv('SHELLMATIC_SHELL', 'cmd')
+    CreateDirectory(embed_data['appdata'])
+    config = _ii.Config()
+    assert _ii._AddAliases(s, config, 'set ALPHA=1', test=True).splitlines()[:2] == [
+        'set ALPHA=1',
+        'cat=type $*',
+    ]
+    assert not os.path.exists(os.path.expandvars(config.macros_filename))
+    assert _ii._AddAliases(s, config, '', test=False) == \
+        'doskey /macrofile="%s"' % os.path.expandvars(config.macros_filename)
+    assert os.path.isfile(os.path.expandvars(config.macros_filename))
+
+
+def testRunCalls(embed_data):
+    import sys
+
+    output_filename = embed_data['calls.txt']
+    state_filename = embed_data['calls.state']
+    python = '"%s"' % sys.executable
+
+    def RunCalls(flags='git', **calls):
+        s = Shellmatic()
+        s.EnvironmentSet('text:CALLS_OUTPUT', output_filename)
+        for i_name, i_command in sorted(calls.items()):
+            s.CallSet(flags + ':' + i_name, i_command)
+        return [(name, retcode) for (name, retcode, _output) in s.RunCalls(state_filename, environ={})]
+
+    def Append(text):
+        # Uses the resolved environment.
+        return python + ' -c "import os; open(os.environ[\'CALLS_OUTPUT\'], \'a\').write(\'%s\')"' % text
+
+    assert RunCalls(alpha=Append('a'), bravo=Append('b')) == [('alpha', 0), ('bravo', 0)]
+    assert RunCalls(alpha=Append('a'), bravo=Append('b')) == []
+
+    # Only the changed calls are executed, failures again until successful.
+    failure = python + ' -c "raise SystemExit(3)"'
+    assert RunCalls(alpha=Append('a'), bravo=Append('B'), charlie=failure) == [
+        ('bravo', 0),
+        ('charlie', 3),
+    ]
+    assert RunCalls(alpha=Append('a'), bravo=Append('B'), charlie=failure) == [('charlie', 3)]
+
+    # The state is kept by call key: the same name with other flags is another call.
+    assert RunCalls(flags='hg', alpha=Append('a')) == [('alpha', 0)]
+    assert RunCalls(flags='hg', alpha=Append('a')) == []
+    assert RunCalls(alpha=Append('a')) == []
+    with open(output_filename) as output_file:
+        assert output_file.read() == 'abBa'
+
+
 def testPathValueAsBatch():
     assert Shellmatic.PathValue('x:/Alpha\\Bravo/CHARLIE').AsBatch() == 'x:\\alpha\\bravo\\charlie'
     assert Shellmatic.PathValue('$shared_dir/alpha').AsBatch() == '%SHARED_DIR%\\alpha'
     assert Shellmatic.PathValue('$python_home;$python_home/scripts').AsBatch() == '%PYTHON_HOME%;%PYTHON_HOME%\\scripts'
 
 
+def testValueReferences(monkeypatch):
+    monkeypatch.setenv('ALPHA', 'x:/alpha')
+    monkeypatch.delenv('CHARLIE', raising=False)
+
+    value = Shellmatic.TextValue('$ALPHA/bravo/$CHARLIE')
+    assert value.GetReferences() == ('ALPHA', 'CHARLIE')
+    assert value.AsBatch() == '%ALPHA%/bravo/%CHARLIE%'
+    assert value.AsBatch(expandvars=True) == 'x:/alpha/bravo/$CHARLIE'
+
+    value = Shellmatic.PathValue('$alpha/Bravo/../charlie')
+    assert value.GetReferences() == ('alpha',)
+    assert value.AsBatch() == '%ALPHA%\\charlie'
+
+    value = Shellmatic.PathListValue(['$ALPHA/bin', 'x:/bravo', '$CHARLIE'])
+    assert value.GetReferences() == ('ALPHA', 'CHARLIE')
+    assert value.ExpandVars().AsList() == ['x:/alpha/bin', 'x:/bravo', '$charlie']
+    assert value.AsList() == ['$alpha/bin', 'x:/bravo', '$charlie']
+
+
+def testValueReferencesSyntax(monkeypatch, tmpdir):
+    import ntpath
+    monkeypatch.setenv('ALPHA', six.text_type(tmpdir))
+    monkeypatch.delenv('CHARLIE', raising=False)
+
+    # Braces, as os.path.expandvars: references to undefined variables are left unchanged.
+    value = Shellmatic.TextValue('${ALPHA}bravo/${CHARLIE}/$CHARLIE')
+    assert value.GetReferences() == ('ALPHA', 'CHARLIE', 'CHARLIE')
+    assert value.AsBatch() == '%ALPHA%bravo/%CHARLIE%/%CHARLIE%'
+    assert value.ExpandVars().AsPrint() == os.path.expandvars(value.AsPrint())
+
+    tmpdir.join('bravo').ensure(dir=True)
+    value = Shellmatic.PathValue('${ALPHA}/bravo')
+    assert value.path == os.path.expandvars('${ALPHA}/bravo')
+    assert value.IsDir()
+    assert Shellmatic.TextValue('${ALPHA}/bravo').IsDir()
+
+    s = Shellmatic()
+    s.EnvironmentSet('text:DELTA', '${ALPHA}/delta')
+    s.EnvironmentSet('pathlist:PATH', ['${PATH}', '${DELTA}/bin'])
+    assert s.environment['text:DELTA'].GetDependencies() == {'ALPHA'}
+    assert s.AsScript('bash') == Dedent(
+        '''
+        export DELTA="${ALPHA}/delta"
+        export PATH="${PATH}:${DELTA}/bin"
+        '''
+    )
+
+    # Windows also references with percents.
+    monkeypatch.setattr(
+        Shellmatic.ValueType, 'REFERENCE_RE', Shellmatic.ValueType.WINDOWS_REFERENCE_RE
+    )
+    value = Shellmatic.TextValue('%ALPHA%\\bravo;%CHARLIE%')
+    assert value.GetReferences() == ('ALPHA', 'CHARLIE')
+    assert value.ExpandVars().AsPrint() == ntpath.expandvars(value.AsPrint())
+
+
+def testPathValueInterning(monkeypatch):
+    monkeypatch.setenv('ALPHA', 'x:/alpha')
+
+    a = Shellmatic.PathValue('$ALPHA/Bravo')
+    assert Shellmatic.PathValue('$ALPHA\\Bravo\\') is a
+    assert Shellmatic.PathValue('$alpha/bravo') is not a
+    assert Shellmatic.PathValue('$alpha/bravo') == a
+    assert hash(Shellmatic.PathValue('$alpha/bravo')) == hash(a)
+
+    expanded = a.ExpandVars()
+    assert expanded.AsPrint() == 'x:/alpha/Bravo'
+    assert a.AsPrint() == '$ALPHA/Bravo'
+
+
+def testPathListValue():
+    value = Shellmatic.PathListValue(
+        r'x:/Alpha;x:\alpha;x:/alpha/.venv/scripts;x:/alpha/.venv;x:/alpha.venv;c:/windows'
+    )
+    assert value.AsList() == [
+        'x:/alpha',
+        'x:/alpha/.venv/scripts',
+        'x:/alpha/.venv',
+        'x:/alpha.venv',
+        'c:/windows',
+    ]
+    assert 'X:/ALPHA' in value
+    assert Shellmatic.PathValue('x:/bravo') not in value
+
+    value.Remove('c:/Windows')
+    with pytest.raises(ValueError):
+        value.Remove('c:/windows')
+
+    removed = value.RemoveTree('x:/alpha/.venv')
+    assert [i.AsPrint() for i in removed] == ['x:/alpha/.venv/scripts', 'x:/alpha/.venv']
+    assert value.AsList() == ['x:/alpha', 'x:/alpha.venv']
+    assert value.RemoveTree('x:/bravo') == []
+
+    value.RemoveTree('x:')
+    assert value.AsList() == []
+
+
+def testPathListValueDoctor(monkeypatch, embed_data):
+    import _ii
+    import io
+
+    data_dir = embed_data.GetDataDirectory()
+    CreateDirectory(embed_data['alpha'])
+    CreateDirectory(embed_data['bravo'])
+    paths = [
+        embed_data['alpha'],
+        embed_data['missing'],
+        '',
+        '$DATA_DIR/alpha/',
+        embed_data['bravo'],
+        embed_data['missing'],
+    ]
+
+    stat_cache = {}
+    report = Shellmatic.PathListValue.Doctor(
+        paths,
+        environ={'DATA_DIR' : data_dir},
+        stat_cache=stat_cache,
+    )
+    assert [problem for (_path, problem) in report] == [
+        None,
+        Shellmatic.PathListValue.PROBLEM_MISSING,
+        Shellmatic.PathListValue.PROBLEM_DUPLICATE,
+        None,
+        Shellmatic.PathListValue.PROBLEM_DUPLICATE,
+    ]
+    assert stat_cache[embed_data['missing']] is False
+
+    # Duplicates are the same directory for the current platform.
+    CreateDirectory(embed_data['Bravo'])
+    report = Shellmatic.PathListValue.Doctor([embed_data['bravo'], embed_data['Bravo']])
+    expected = Shellmatic.PathListValue.PROBLEM_DUPLICATE if os.name == 'nt' else None
+    assert report[1][1] == expected
+    optimized = Shellmatic.PathListValue.Optimize(paths, stat_cache=stat_cache, threads=1)
+    assert [i.path for i in optimized] == [embed_data['alpha'], embed_data['bravo']]
+
+    # "ii doctor" reports the current environment and emits the optimized path-list.
+    monkeypatch.setenv('SHELLMATIC_BATCH', '-')
+    monkeypatch.setenv('SHELLMATIC_SHELL', 'bash')
+    monkeypatch.setenv('TOOLS_PATH', os.pathsep.join(paths[:2] + paths[4:]))
+    monkeypatch.setattr(_ii, '_script_stream', io.StringIO())
+    console = BufferedConsole()
+    assert _ii.FastMain(['doctor', '--name=TOOLS_PATH', '--optimize'], console)
+    assert '2 of 4 paths with problems.' in console.GetOutput()
+    assert _ii._script_stream.getvalue() == 'export TOOLS_PATH="%s:%s"\n' % (
+        embed_data['alpha'],
+        embed_data['bravo'],
+    )
+
+    # Paths differing only in case are kept on POSIX.
+    if os.name != 'nt':
+        optimized = Shellmatic.PathListValue.Optimize([embed_data['bravo'], embed_data['Bravo']])
+        assert [i.path for i in optimized] == [embed_data['bravo'], embed_data['Bravo']]
+        monkeypatch.setenv(
+            'TOOLS_PATH',
+            os.pathsep.join([embed_data['bravo'], embed_data['missing'], embed_data['Bravo']]),
+        )
+        monkeypatch.setattr(_ii, '_script_stream', io.StringIO())
+        assert _ii.FastMain(['doctor', '--name=TOOLS_PATH', '--optimize'], console)
+        assert _ii._script_stream.getvalue() == 'export TOOLS_PATH="%s:%s"\n' % (
+            embed_data['bravo'],
+            embed_data['Bravo'],
+        )
+
+
+def testExecutableIndex(monkeypatch, embed_data):
+    import stat
+
+    for i_filename in ('python/python.exe', 'python/python.bat', 'python/readme.txt', 'git/git.exe'):
+        CreateFile(embed_data[i_filename], '')
+    CreateFile(embed_data['venv/Python.EXE'], '')
+    paths = [embed_data['venv'], embed_data['python'], embed_data['missing'], embed_data['git']]
+    index_filename = embed_data['executables.index']
+
+    scanned = []
+    original_scan = Shellmatic.ExecutableIndex._ScanDirectory
+    def ScanDirectory(self, directory):
+        scanned.append(os.path.basename(directory))
+        return original_scan(self, directory)
+    monkeypatch.setattr(Shellmatic.ExecutableIndex, '_ScanDirectory', ScanDirectory)
+
+    index = Shellmatic.ExecutableIndex(index_filename, paths, pathext=['.exe', '.bat'])
+    assert scanned == ['venv', 'python', 'git']
+    assert index.Which('PYTHON') == embed_data['venv/Python.EXE']
+    assert index.Which('readme') is None
+    assert index.GetShadowed() == [
+        ('python', [embed_data['venv/Python.EXE'], embed_data['python/python.exe']]),
+    ]
+
+    # Only the changed directories are listed again.
+    del scanned[:]
+    Shellmatic.ExecutableIndex(index_filename, paths, pathext=['.exe', '.bat'])
+    assert scanned == []
+    os.remove(embed_data['venv/Python.EXE'])
+    index = Shellmatic.ExecutableIndex(index_filename, paths, pathext=['.exe', '.bat'])
+    assert scanned == ['venv']
+    assert index.Which('python') == embed_data['python/python.exe']
+
+    # On Windows only BATCH files have shims.
+    CreateFile(embed_data['tools/build.bat'], '')
+    index = Shellmatic.ExecutableIndex(
+        index_filename,
+        paths + [embed_data['tools']],
+        pathext=['.exe', '.bat'],
+    )
+    shims_dir = embed_data['shims']
+    CreateFile(embed_data['shims/stale.cmd'], '')
+    assert index.CreateShims(shims_dir) == 1
+    assert os.listdir(shims_dir) == ['build.bat']
+    with open(embed_data['shims/build.bat']) as shim_file:
+        assert shim_file.read() == '@"%s" %%*' % embed_data['tools/build.bat']
+    assert index.CreateShims(shims_dir) == 0
+
+    if os.name != 'nt':
+        os.chmod(embed_data['git/git.exe'], stat.S_IRWXU)
+        index = Shellmatic.ExecutableIndex(embed_data['posix.index'], paths, pathext=[])
+        assert index.Which('git.exe') == embed_data['git/git.exe']
+        assert index.Which('python.exe') is None
+        assert index.CreateShims(embed_data['launchers']) == 1
+        assert os.access(embed_data['launchers/git.exe'], os.X_OK)
+        assert index.CreateShims(embed_data['launchers']) == 0
+
+
+@pytest.mark.skipif(os.name == 'nt', reason='POSIX shims')
+def testExecutableIndexVirtualenvShim(embed_data):
+    import subprocess
+    import sys
+
+    # Shims launch the executables from their own directory: a virtualenv python finds its
+    # pyvenv.cfg.
+    venv_dir = embed_data['venv']
+    subprocess.check_call([sys.executable, '-m', 'venv', '--without-pip', venv_dir])
+    index = Shellmatic.ExecutableIndex(
+        embed_data['executables.index'],
+        [os.path.join(venv_dir, 'bin')],
+        pathext=[],
+    )
+    index.CreateShims(embed_data['shims'])
+    output = subprocess.check_output(
+        [embed_data['shims/python'], '-c', 'import sys; print(sys.prefix)'],
+    )
+    assert os.path.realpath(output.decode('UTF-8').strip()) == os.path.realpath(venv_dir)
+
+
 def testWorkon(monkeypatch, embed_data, shutils=None):
     console = BufferedConsole()
 
@@ -205,13 +1099,28 @@ def testWorkon(monkeypatch, embed_data, shutils=None):
     )
 
     s = Shellmatic()
-    s.Workon(console, 'alpha')
+    s.Workon(console, 'alpha', environ={})
     s.PrintList(console, logo=False)
 
+    def Added(*paths):
+        # The paths added to a path-list, as in the current platform environment.
+        return [j for i in paths for j in os.path.normpath(i).split(os.pathsep)]
+
+    stack = Shellmatic._EncodeStack([
+        ('alpha', [
+            ('ALPHA_DIR', None, None),
+            ('PATH', None, Added(embed_data['alpha/.venv/scripts'], 'x:/alpha/bin')),
+            ('PYTHONHOME', None, None),
+            ('PYTHONPATH', None, Added('x:/alpha')),
+            ('VIRTUALENV', None, None),
+        ]),
+    ])
     assert console.GetOutput() == Dedent(
         '''
             {embed_dir}/alpha/.venv: Activating virtualenv.
             {embed_dir}/alpha/.shellmatic.json: Loading configuration.
+            _environ:nodep:text
+                - SHELLMATIC_STACK: {stack}
             alpha:path
                 - ALPHA_DIR: x:/alpha
             alpha:path:venv
@@ -227,5 +1136,261 @@ def testWorkon(monkeypatch, embed_data, shutils=None):
             alpha:text:venv
                 - VIRTUALENV: alpha
 
-        '''.format(embed_dir=embed_data.GetDataDirectory()).replace('\\b', ' ')
+        '''.format(embed_dir=embed_data.GetDataDirectory(), stack=stack).replace('\\b', ' ')
     )
+
+
+def testActivationStack(monkeypatch, embed_data):
+    monkeypatch.setenv('PROJECTS_DIR', embed_data.GetDataDirectory())
+    for i_name in ('alpha', 'bravo'):
+        CreateDirectory(embed_data[i_name + '/.venv'])
+        CreateFile(
+            embed_data[i_name + '/.shellmatic.json'],
+            '{"environment": {"%s_DIR": "x:/%s"}}' % (i_name.upper(), i_name)
+        )
+    shell = {'PATH': 'c:\\windows', 'PYTHONHOME': 'c:\\python27'}
+
+    def Execute(operation, *args, **kwargs):
+        # Simulates the execution of the script generated in the (cmd.exe) shell environment.
+        environ = Shellmatic.BatchEnviron(shell)
+        s = Shellmatic()
+        assert getattr(s, operation)(Null(), *args, environ=environ, **kwargs)
+        return {i : v for (i, v) in six.iteritems(s.Resolve(environ, append=True)) if v}
+
+    def Venvs(environ):
+        return [i for (i, _frame) in Shellmatic._GetStack(environ)]
+
+    alpha = Execute('Workon', 'alpha')
+    assert alpha['ALPHA_DIR'] == 'x:\\alpha'
+    assert alpha['PATH'].startswith('c:\\windows;')
+    assert Venvs(alpha) == ['alpha']
+
+    # Switching deactivates alpha.
+    shell = alpha
+    bravo = Execute('Workon', 'bravo')
+    assert 'ALPHA_DIR' not in bravo
+    assert bravo['VIRTUALENV'] == 'bravo'
+    assert bravo['PATH'].count(';') == 1
+    assert Venvs(bravo) == ['bravo']
+
+    # Nesting keeps alpha, restored on deactivation.
+    nested = Execute('Workon', 'bravo', push=True)
+    assert Venvs(nested) == ['alpha', 'bravo']
+    shell = nested
+    assert Execute('Deactivate') == alpha
+    shell = alpha
+    assert Execute('Deactivate') == {'PATH': 'c:\\windows', 'PYTHONHOME': 'c:\\python27'}
+
+    # Only the paths added by the activation are removed, keeping the ones added since.
+    shell = dict(alpha, PATH=alpha['PATH'] + ';c:\\tools')
+    assert Execute('Deactivate') == \
+        {'PATH': 'c:\\windows;c:\\tools', 'PYTHONHOME': 'c:\\python27'}
+
+    shell = {}
+    assert not Shellmatic().Deactivate(Null(), environ=shell)
+
+
+def testPrebuildProjects(monkeypatch, embed_data):
+    monkeypatch.setenv('PROJECTS_DIR', embed_data['projects'])
+    monkeypatch.delenv('VIRTUALENV', raising=False)
+    cache_filename = embed_data['projects.cache']
+
+    CreateDirectory(embed_data['projects/alpha/.venv'])
+    CreateDirectory(embed_data['projects/bravo'])
+    CreateFile(
+        embed_data['projects/alpha/.shellmatic.json'],
+        '{"environment": {"ALPHA_DIR": "x:/alpha", "PATH": ["$ALPHA_DIR/bin"]},'
+        ' "aliases": {"ll": "ls -l"}, "calls": {"hooks": "git config core.hooksPath .hooks"}}'
+    )
+
+    assert Shellmatic().PrebuildProjects(cache_filename, processes=2) == ['alpha']
+    cache = Shellmatic._LoadProjectsCache(cache_filename)
+    assert sorted(cache) == ['alpha']
+
+    def Workon(cache_filename):
+        s = Shellmatic()
+        assert s.Workon(Null(), 'alpha', cache_filename=cache_filename)
+        return s.AsBatch(Null())
+
+    expected = Workon(None)
+    assert 'set ALPHA_DIR=x:' in expected
+    assert Workon(cache_filename) == expected
+    assert Shellmatic._LoadProjectsCache(cache_filename) == cache
+
+    # The project aliases and calls are activated too.
+    s = Shellmatic()
+    s.Workon(Null(), 'alpha', cache_filename=cache_filename)
+    assert s.AsAliases('bash') == 'alias ll="ls -l"'
+    assert list(s.calls.items()) == [('alpha:hooks', 'git config core.hooksPath .hooks')]
+
+    # Stale entries are rebuilt and updated.
+    CreateFile(embed_data['projects/alpha/.shellmatic.json'], '{"environment": {}}')
+    assert 'ALPHA_DIR' not in Workon(cache_filename)
+    assert Shellmatic._LoadProjectsCache(cache_filename)['alpha'][0] != cache['alpha'][0]
+
+    assert not Shellmatic().Workon(Null(), 'bravo', cache_filename=cache_filename)
+
+
+def testProjectIndex(monkeypatch, embed_data):
+    import time
+
+    monkeypatch.setenv('PROJECTS_DIR', embed_data['projects'])
+    index_filename = embed_data['projects.index']
+
+    CreateDirectory(embed_data['projects/alpha/.venv'])
+    CreateDirectory(embed_data['projects/alpine/.venv'])
+    CreateDirectory(embed_data['projects/bravo'])
+    CreateFile(embed_data['projects/alpha/.shellmatic.json'], '{}')
+
+    index = Shellmatic.ProjectIndex(index_filename)
+    assert index.Complete() == ['alpha', 'alpine']
+    assert index.Complete('AL') == ['alpha', 'alpine']
+    assert index.Complete('alph') == ['alpha']
+    assert index.Complete('b') == []
+    assert index.GetProject('alpha') == (
+        embed_data['projects/alpha'],
+        embed_data['projects/alpha/.venv'],
+        embed_data['projects/alpha/.venv/scripts'],
+        True,
+    )
+    assert index.GetProject('alpine')[3] is False
+    assert index.GetProject('charlie') is None
+
+    # Loaded from the index file, revalidated by the directories modification times.
+    monkeypatch.setattr(Shellmatic.ProjectIndex, '_ScanProject', None)
+    assert Shellmatic.ProjectIndex(index_filename).Complete() == ['alpha', 'alpine']
+    monkeypatch.undo()
+
+    time.sleep(0.01)
+    monkeypatch.setenv('PROJECTS_DIR', embed_data['projects'])
+    CreateDirectory(embed_data['projects/bravo/.venv'])
+    CreateDirectory(embed_data['projects/charlie/.venv'])
+    assert Shellmatic.ProjectIndex(index_filename).Complete() == \
+        ['alpha', 'alpine', 'bravo', 'charlie']
+
+
+def testFastStartup(embed_data):
+    import subprocess
+    import sys
+
+    # Import budget for the FAST_COMMANDS, executed as "ii" does: the full application (clikit)
+    # and the ben10 modules shellmatic doesn't need are not loaded.
+    script = Dedent(
+        '''
+        import runpy, sys
+        sys.argv = ['_ii.py', 'set', 'text:ALPHA', 'Alpha']
+        runpy.run_path('_ii.py', run_name='__main__')
+        print(sorted(i for i in sys.modules if i.split('.')[0] in ('clikit', 'ben10')))
+        '''
+    )
+    environ = dict(os.environ, SHELLMATIC_BATCH=embed_data['shellmatic.bat'])
+    environ.pop('SHELLMATIC_SERVER', None)
+    output = subprocess.check_output(
+        [sys.executable, '-c', script],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=environ,
+    )
+    modules = eval(output.decode('UTF-8').splitlines()[-1])
+    assert not [i for i in modules if i.split('.')[0] == 'clikit']
+    assert 'ben10.execute' not in modules or sys.version_info[0] == 2
+    assert os.path.isfile(embed_data['shellmatic.bat'])
+
+
+def testFastMain(monkeypatch, embed_data):
+    import _ii
+
+    monkeypatch.setenv('SHELLMATIC_BATCH', embed_data['shellmatic.bat'])
+    monkeypatch.delenv('SHELLMATIC_SHELL', raising=False)
+
+    console = BufferedConsole()
+    assert _ii.FastMain(['set', 'text:ALPHA', 'Alpha', '--test'], console)
+    assert console.GetOutput().endswith('    set ALPHA=Alpha\n')
+
+    assert _ii.FastMain(['set', 'text:ALPHA', 'Alpha'], BufferedConsole())
+    assert os.path.isfile(embed_data['shellmatic.bat'])
+
+    # Only the changes to the current environment, unless the full script is requested.
+    monkeypatch.setenv('ALPHA', 'Alpha')
+    console = BufferedConsole()
+    assert _ii.FastMain(['set', 'text:ALPHA', 'Alpha', '--test'], console)
+    assert 'set ALPHA=Alpha' not in console.GetOutput()
+    console = BufferedConsole()
+    assert _ii.FastMain(['set', 'text:ALPHA', 'Alpha', '--full', '--test'], console)
+    assert console.GetOutput().endswith('    set ALPHA=Alpha\n')
+
+    # Handled by the full application.
+    assert not _ii.FastMain([], console)
+    assert not _ii.FastMain(['list'], console)
+    assert not _ii.FastMain(['set', 'text:ALPHA'], console)
+    assert not _ii.FastMain(['set', 'text:ALPHA', 'Alpha', 'True', 'extra'], console)
+    assert not _ii.FastMain(['set', 'text:ALPHA', 'Alpha', '--test=yes'], console)
+    assert not _ii.FastMain(['set', 'text:ALPHA', 'Alpha', '--unknown'], console)
+    assert not _ii.FastMain(['set', '--help'], console)
+
+
+def testOutputBatch(monkeypatch, embed_data):
+    import _ii
+    import io
+
+    # Eval mode: the script is written to stdout (_script_stream), the messages to the console.
+    monkeypatch.setenv('SHELLMATIC_BATCH', '-')
+    monkeypatch.setattr(_ii, '_script_stream', io.StringIO())
+    console = BufferedConsole()
+    assert _ii.FastMain(['set', 'text:ALPHA', 'Alpha'], console)
+    assert _ii._script_stream.getvalue() == 'set ALPHA=Alpha\n'
+    assert 'ALPHA' in console.GetOutput()
+
+    # The file is replaced atomically, without leaving temporary files.
+    monkeypatch.setenv('SHELLMATIC_BATCH', embed_data['shellmatic.bat'])
+    assert _ii.FastMain(['set', 'text:ALPHA', 'Alpha'], console)
+    assert _ii.FastMain(['set', 'text:ALPHA', 'Bravo'], console)
+    assert os.listdir(embed_data.GetDataDirectory()) == ['shellmatic.bat']
+    with open(embed_data['shellmatic.bat']) as batch_file:
+        assert batch_file.read() == 'set ALPHA=Bravo'
+
+    # By default each shell has its own file.
+    monkeypatch.delenv('SHELLMATIC_BATCH')
+    shell_pid = getattr(os, 'getppid', os.getpid)()
+    assert _ii.Config().batch_filename == '$TEMP/.shellmatic-%d.bat' % shell_pid
+
+
+def testServer(monkeypatch, embed_data):
+    from contextlib import closing
+    from multiprocessing.connection import Client, Listener
+    import _ii
+    import threading
+
+    monkeypatch.setenv('APPDATA', embed_data.GetDataDirectory())
+    monkeypatch.setenv('SHELLMATIC_SERVER', embed_data['shellmatic.sock'])
+    config = _ii.Config()
+
+    # No server: the command is executed in-process.
+    assert not _ii.ClientMain(['set', 'text:ALPHA', 'Alpha', '--test'])
+
+    listener = Listener(
+        str(config.server_address),
+        authkey=_ii._GetServerKey(config, create=True)
+    )
+
+    def Serve():
+        with closing(listener.accept()) as connection:
+            _ii._ServeConnection(connection)
+
+    with closing(listener):
+        for i_argv, i_handled in (
+            (['set', 'text:ALPHA', 'Alpha', '--test'], True),
+            (['list'], False),
+        ):
+            thread = threading.Thread(target=Serve)
+            thread.start()
+            console = BufferedConsole()
+            assert _ii.ClientMain(i_argv, console) == i_handled
+            thread.join()
+            if i_handled:
+                assert console.GetOutput().endswith('    set ALPHA=Alpha\n')
+
+        # Clients disconnecting before the request do not stop the server.
+        thread = threading.Thread(target=Serve)
+        thread.start()
+        Client(str(config.server_address), authkey=_ii._GetServerKey(config)).close()
+        thread.join()